@@ -0,0 +1,233 @@
+"""
+사용자 전체 대화 기록 백업/복원 (gzip NDJSON 아카이브)
+
+    python archive.py export --user abcd@gmail.com --out backup.ndjson.gz
+    python archive.py import --file backup.ndjson.gz [--user other@gmail.com]
+
+아카이브 첫 줄은 {"type": "archive", ...} 정보, 이후 한 줄에 세션 하나
+({"type": "session", "session_id", "header", "messages"}). blob으로 저장된 본문은 풀어서 넣습니다.
+
+Firestore 에뮬레이터에서 시험할 때는 FIRESTORE_EMULATOR_HOST를 설정하면
+secrets의 서비스 계정 대신 에뮬레이터에 연결합니다. (--project로 프로젝트 ID 지정, 기본 demo-archive)
+Anthropic API는 쓰지 않으므로 ANTHROPIC_API_KEY는 필요 없습니다.
+에뮬레이터에서 백업/복원 왕복을 확인하려면 check_archive.py를 실행합니다.
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import history
+
+archive_version = 1
+read_batch_size = 100  # get_all 한 번에 읽는 문서 수
+workers = 8            # 동시에 실행하는 get_all / 배치 커밋 수
+
+
+def _encode(value):
+    # Firestore 타임스탬프(updated_at 등)는 표시를 붙여 문자열로 저장하고 복원할 때 되돌림
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f"{type(value).__name__}은(는) 아카이브에 저장할 수 없습니다")
+
+
+def _decode(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _get_all(db, executor, refs):
+    """문서 참조 목록을 read_batch_size씩 나눠 동시에 get_all로 읽습니다. 존재하는 스냅샷만 반환합니다."""
+    batches = executor.map(lambda chunk: [doc for doc in db.get_all(chunk) if doc.exists], _chunks(refs, read_batch_size))
+    return [doc for batch in batches for doc in batch]
+
+
+def export_user_archive(db, user_email, path):
+    """사용자의 모든 세션을 읽어 gzip NDJSON 아카이브로 씁니다. 세션 수를 반환합니다."""
+    start = time.monotonic()
+    user_ref = db.collection('conversations').document(user_email)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # 1) 세션 헤더
+        session_refs = list(user_ref.collection('sessions').list_documents())
+        headers = _get_all(db, executor, session_refs)
+
+        # 2) 메시지: 문서 ID가 인덱스(000000, 000001, ...)라서 헤더의 message_count로 참조를 바로 만듦
+        message_refs = []
+        for header in headers:
+            data = header.to_dict()
+            if 'messages' not in data:  # 이전 형식(문서 안 배열)은 헤더에 이미 있음
+                messages_ref = header.reference.collection('messages')
+                message_refs += [messages_ref.document(f"{i:06d}") for i in range(data.get('message_count', 0))]
+        message_docs = {}
+        for doc in _get_all(db, executor, message_refs):
+            message_docs.setdefault(doc.reference.parent.parent.id, []).append(doc.to_dict())
+
+        # 3) blob으로 저장된 본문
+        digests = sorted({m['content_ref'] for docs in message_docs.values() for m in docs if 'content_ref' in m})
+        blob_docs = _get_all(db, executor, [history._blob_ref(db, user_email, d) for d in digests])
+        parts = {}  # 나눠 저장된 blob의 조각
+        part_refs = [ref for doc in blob_docs for ref in history._blob_part_refs(doc.reference, doc.to_dict())]
+        for part in _get_all(db, executor, part_refs):
+            parts.setdefault(part.reference.parent.parent.id, []).append(part)
+        blobs = {doc.id: history._blob_content(doc.to_dict(), parts.get(doc.id, ())) for doc in blob_docs}
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'type': 'archive', 'version': archive_version, 'user_email': user_email,
+                            'exported_at': datetime.now().isoformat(), 'sessions': len(headers)}, ensure_ascii=False) + "\n")
+        for header in headers:
+            data = header.to_dict()
+            messages = data.pop('messages', None)
+            if messages is None:
+                docs = sorted(message_docs.get(header.id, []), key=lambda m: m['index'])
+                messages = []
+                for m in docs:
+                    if 'content_ref' in m:
+                        digest = m.pop('content_ref')
+                        if digest not in blobs:
+                            print(f"메시지 본문을 찾을 수 없습니다: {header.id} {digest}")
+                        m['content'] = blobs.get(digest, "")
+                    messages.append({k: v for k, v in m.items() if k != 'index' and v is not None})
+            data.pop('search_terms', None)  # 이전 형식의 검색 단어 (복원할 때 메시지에서 다시 만듦)
+            f.write(json.dumps({'type': 'session', 'session_id': header.id, 'header': data, 'messages': messages},
+                               ensure_ascii=False, separators=(',', ':'), default=_encode) + "\n")
+
+    print(f"{user_email}: 세션 {len(headers)}개, 메시지 {len(message_refs)}개, blob {len(blobs)}개를 "
+          f"{path}에 저장했습니다. ({time.monotonic() - start:.1f}초)")
+    return len(headers)
+
+
+def _read_archive(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                record = json.loads(line, object_hook=_decode)
+                if line_number == 1:
+                    if record.get('type') != 'archive' or record.get('version') != archive_version:
+                        raise ValueError(f"{path}은(는) 지원하지 않는 아카이브입니다")
+                yield record
+
+
+class _BatchWriter:
+    """쓰기 작업을 max_batch_ops개 또는 문서 크기 합 max_batch_bytes까지 묶어 커밋합니다. 가득 찬 배치는 스레드 풀에서 동시에 커밋됩니다."""
+
+    def __init__(self, db, executor):
+        self.db = db
+        self.executor = executor
+        self.batch = db.batch()
+        self.ops = 0
+        self.size = 0
+        self.futures = []
+        self.commits = 0
+
+    def set(self, ref, data):
+        data_bytes = history._doc_bytes(data)
+        if self.size + data_bytes > history.max_batch_bytes:
+            self._commit()
+        self.batch.set(ref, data)
+        self.ops += 1
+        self.size += data_bytes
+        if self.ops == history.max_batch_ops:
+            self._commit()
+
+    def _commit(self):
+        if self.ops:
+            self.futures.append(self.executor.submit(self.batch.commit))
+            self.commits += 1
+            self.batch = self.db.batch()
+            self.ops = 0
+            self.size = 0
+
+    def close(self):
+        """남은 작업을 커밋하고 모든 커밋이 끝날 때까지 기다립니다 (실패하면 예외 발생)."""
+        self._commit()
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+def import_user_archive(db, path, user_email=None):
+    """
+    아카이브의 세션을 복원합니다. user_email을 주면 그 사용자 아래로 복원합니다.
+    참조가 항상 존재하도록 blob을 먼저 모두 쓰고, 그다음 메시지와 세션 헤더를 씁니다. 세션 수를 반환합니다.
+    """
+    start = time.monotonic()
+    user_email = user_email or next(_read_archive(path))['user_email']
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # 1) blob (아카이브를 한 번 읽으며 중복 없이)
+        writer = _BatchWriter(db, executor)
+        digests = set()
+        for record in _read_archive(path):
+            if record['type'] != 'session':
+                continue
+            for i, message in enumerate(record['messages']):
+                blob_writes = {}
+                history._externalize_content(db, user_email, history._message_doc(i, message), blob_writes)
+                for digest, (blob_docs, _) in blob_writes.items():
+                    if digest not in digests:
+                        digests.add(digest)
+                        for ref, blob in blob_docs:
+                            writer.set(ref, blob)
+        writer.close()
+        blob_commits = writer.commits
+
+        # 2) 메시지와 세션 헤더
+        writer = _BatchWriter(db, executor)
+        sessions = 0
+        for record in _read_archive(path):
+            if record['type'] != 'session':
+                continue
+            session_id = record['session_id']
+            session_ref = history._session_ref(db, user_email, session_id)
+            messages_ref = session_ref.collection('messages')
+            for i, message in enumerate(record['messages']):
+                doc = history._message_doc(i, message)
+                writer.set(messages_ref.document(f"{i:06d}"), history._externalize_content(db, user_email, doc, {}))
+            header = dict(record['header'], session_id=session_id, user_email=user_email,
+                          message_count=len(record['messages']))
+            terms = history.session_search_terms(record['messages'], header.get('preview'))
+            writer.set(history._terms_ref(db, user_email, session_id), {'terms': terms})
+            writer.set(session_ref, header)
+            sessions += 1
+        writer.close()
+
+    # 이 프로세스의 캐시된 세션 목록은 다시 읽도록 비움
+    with history._session_index_lock:
+        history._session_index.pop(user_email, None)
+    print(f"{user_email}: 세션 {sessions}개, blob {len(digests)}개를 복원했습니다. "
+          f"(배치 커밋 {blob_commits + writer.commits}회, {time.monotonic() - start:.1f}초)")
+    return sessions
+
+
+def connect(project=None):
+    """FIRESTORE_EMULATOR_HOST가 있으면 에뮬레이터, 없으면 앱과 같은 Firestore 클라이언트를 사용합니다."""
+    if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        from google.cloud import firestore
+        return firestore.Client(project=project or 'demo-archive')
+    return history.initialize_firebase()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="사용자 대화 기록 백업/복원")
+    parser.add_argument('--project', help="에뮬레이터에서 사용할 프로젝트 ID")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help="사용자의 모든 세션을 아카이브로 저장")
+    export_parser.add_argument('--user', required=True)
+    export_parser.add_argument('--out', required=True)
+    import_parser = commands.add_parser('import', help="아카이브의 세션을 복원")
+    import_parser.add_argument('--file', required=True)
+    import_parser.add_argument('--user', help="다른 사용자 아래로 복원할 때 지정")
+    args = parser.parse_args()
+
+    db = connect(args.project)
+    if args.command == 'export':
+        export_user_archive(db, args.user, args.out)
+    else:
+        import_user_archive(db, args.file, args.user)
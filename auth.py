@@ -1,25 +1,89 @@
 import extra_streamlit_components as stx
+from extra_streamlit_components.CookieManager import _component_func as _cookie_component
 import streamlit as st
 import datetime
+import threading
 import time
 
+class CookieManager(stx.CookieManager):
+    """브라우저 쿠키가 아직 도착하지 않은 상태(ready=False)와 쿠키가 없는 상태를 구분하는 CookieManager.
+    (기본 CookieManager는 두 경우 모두 {}를 반환함)"""
+
+    def __init__(self, key="init"):
+        self.cookie_manager = _cookie_component
+        cookies = self.cookie_manager(method="getAll", key=key, default=None)
+        self.ready = cookies is not None  # 컴포넌트가 쿠키를 보내오면 스크립트가 다시 실행됨
+        self.cookies = cookies if cookies is not None else {}
+
 # 페이지 설정 및 쿠키 컨트롤러 초기화
 def initialize_cookie(cookie_manager, COOKIE_KEY):
+    """쿠키로 로그인 상태를 복원합니다. 이번 실행에서 쿠키로 로그인된 경우 True를 반환합니다."""
+    # 쿠키가 도착하기 전 실행에서도 로그인 상태를 참조할 수 있도록 기본값 설정
+    if 'user_email' not in st.session_state:
+        st.session_state.user_email = None
+    if 'user_name' not in st.session_state:
+        st.session_state.user_name = None
+
+    apply_pending_cookie(cookie_manager, COOKIE_KEY)
     if 'cookie_initialized' not in st.session_state:
+        # 고정 대기 대신, 쿠키 컴포넌트가 응답하면 다시 실행되는 다음 실행에서 읽음
+        if not getattr(cookie_manager, 'ready', True):
+            return False
         try:
             user_cookie = cookie_manager.get(COOKIE_KEY)
-            time.sleep(1)
             if user_cookie is not None:
                 print("cookie with", user_cookie)
                 st.session_state.user_email = user_cookie.get("email")
                 st.session_state.user_name = user_cookie.get("name")
                 st.session_state.cookie_initialized = True
+                return True
             else:
                 print("no cookie")
                 st.session_state.cookie_initialized = True
         except Exception as e:
             print(f"Cookie error: {e}")
             st.session_state.cookie_initialized = True
+    return False
+
+# 쿠키 변경(로그인/로그아웃): 요청을 session_state에 남겨두고, 브라우저가 처리했다고 응답할 때까지 매 실행마다 그림
+def request_cookie_change(method, value=None):
+    st.session_state.pending_cookie = {'method': method, 'value': value, 'id': time.time_ns()}
+
+def apply_pending_cookie(cookie_manager, COOKIE_KEY):
+    pending = st.session_state.get('pending_cookie')
+    if pending is None:
+        return
+
+    key = f"cookie_{pending['method']}_{pending['id']}"
+    if st.session_state.get(key):  # 컴포넌트가 처리 완료(True)를 보내옴
+        st.session_state.pending_cookie = None
+        print("쿠키 설정 완료" if pending['method'] == 'set' else "쿠키 삭제 완료")
+        return
+
+    try:
+        if pending['method'] == 'set':
+            # 쿠키 설정 수정 - 클라우드 환경 고려
+            expires_at = datetime.datetime.now() + datetime.timedelta(days=7)
+            cookie_manager.set(
+                COOKIE_KEY,
+                pending['value'],
+                key=key,
+                expires_at=expires_at,
+                secure=False,  # 로컬/클라우드 모두 호환
+                same_site='lax'
+            )
+        elif COOKIE_KEY in cookie_manager.cookies:
+            cookie_manager.delete(COOKIE_KEY, key=key)
+        else:  # 브라우저에 지울 쿠키가 없음
+            st.session_state.pending_cookie = None
+    except Exception as e:
+        print(f"쿠키 변경 실패: {e}")
+        st.session_state.pending_cookie = None
+
+# 사용자 정보 캐시 (프로세스 전체 공유): 등록된 사용자만 저장하고, 미등록 이메일은 매번 Firestore에서 확인
+user_cache_ttl = 600  # 초
+_user_cache = {}      # email -> (name, fetched_at)
+_user_cache_lock = threading.Lock()
 
 # 사용자 인증 함수
 def authenticate_user(db, email):
@@ -27,11 +91,20 @@ def authenticate_user(db, email):
         return None
 
     email = email.lower().strip()
+    with _user_cache_lock:
+        cached = _user_cache.get(email)
+    if cached and time.time() - cached[1] < user_cache_ttl:
+        return cached[0]
+
     user_doc = db.collection('users').document(email).get()
 
     if user_doc.exists:
         user_data = user_doc.to_dict()
-        return user_data.get('name')
+        user_name = user_data.get('name')
+        if user_name:
+            with _user_cache_lock:
+                _user_cache[email] = (user_name, time.time())
+        return user_name
     return None
 
 def login(db, cookie_manager, COOKIE_KEY):
@@ -49,21 +122,8 @@ def login(db, cookie_manager, COOKIE_KEY):
         st.session_state.user_name = user_name
         st.session_state.login_error = False
         user_data = {'email': email, 'name': user_name}
-
-        # 쿠키 설정 수정 - 클라우드 환경 고려
-        expires_at = datetime.datetime.now() + datetime.timedelta(days=7)
-        try:
-            cookie_manager.set(
-                COOKIE_KEY,
-                user_data,
-                expires_at=expires_at,
-                secure=False,  # 로컬/클라우드 모두 호환
-                same_site='lax'
-            )
-            time.sleep(1)
-            print("쿠키 설정 완료")
-        except Exception as e:
-            print(f"쿠키 설정 실패: {e}")
+        # 쿠키는 다음 실행의 initialize_cookie에서 설정
+        request_cookie_change('set', user_data)
 
     else:
         st.session_state.login_error = True
@@ -73,10 +133,6 @@ def logout(cookie_manager, COOKIE_KEY):
     st.session_state.user_email = None
     st.session_state.user_name = None
     st.session_state.email_input = ""
-    try:
-        cookie_manager.delete(COOKIE_KEY)
-        time.sleep(1)
-        print("쿠키 삭제 완료")
-    except Exception as e:
-        print(f"쿠키 삭제 실패: {e}")
+    # 쿠키는 다음 실행의 initialize_cookie에서 삭제
+    request_cookie_change('delete')
     st.rerun()
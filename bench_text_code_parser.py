@@ -0,0 +1,368 @@
+"""
+text_code_parser 벤치마크
+
+기준 구현(최초 버전의 render_mixed_content)과 현재 구현의 출력이 코퍼스 전체에서 같은지 확인하고,
+입력 크기별 처리 시간과 줄 분류 / 문자열 이스케이프의 초당 처리 줄 수를 비교합니다.
+
+    python bench_text_code_parser.py
+"""
+import random
+import re
+import time
+
+import text_code_parser
+
+
+# ---------------------------------------------------------------------------
+# 기준 구현 (최초 버전 그대로, 출력 비교용)
+# ---------------------------------------------------------------------------
+
+def legacy_escape_literal_newlines_fixed(code: str) -> str:
+    def esc_string_literals(match):
+        literal = match.group(0)
+        literal = literal.replace("\n", "\\n")
+        return literal
+
+    code = re.sub(r'""".*?"""', esc_string_literals, code, flags=re.DOTALL)
+    code = re.sub(r"'''.*?'''", esc_string_literals, code, flags=re.DOTALL)
+    code = re.sub(r'"(?:[^"\\]|\\.)*"', esc_string_literals, code)
+    code = re.sub(r"'(?:[^'\\]|\\.)*'", esc_string_literals, code)
+    return code
+
+
+def legacy_is_code_line(line: str) -> bool:
+    stripped = line.strip()
+    if not stripped:
+        return None
+    if re.match(r'^[\(\)\[\]\{\}\s,]*$', stripped) and any(c in stripped for c in "(){}[]"):
+        return True
+    if (
+        bool(re.match(r"^(for|if|elif|else|while|def|class|try|except|finally|with|async\s+def|await|match|case|return|yield|raise|break|continue|pass|import|from|global|nonlocal|assert)\b", stripped))
+        or stripped.startswith("#")
+        or stripped.startswith("@")
+        or line.startswith(" ") or line.startswith("\t")
+    ):
+        return True
+    if bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_\.]*\s*\([^)]*\)\s*$", stripped)):
+        return True
+    if bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_,\s]*\s*=\s*.+", stripped)):
+        return True
+    if any(c in stripped for c in "(){}[]"):
+        if (stripped.count('(') == stripped.count(')') and
+            not any(stripped.startswith(op) for op in ['if ', 'for ', 'while ', 'def ', 'class ']) and
+            not bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_\.]*\s*\(", stripped))):
+            return False
+        return True
+    return False
+
+
+def legacy_render_mixed_content(content: str) -> str:
+    lines = content.splitlines()
+    current_block = []
+    current_type = None
+    result_parts = []
+
+    def flush():
+        nonlocal current_block, current_type
+        if not current_block:
+            return
+        text = "\n".join(current_block)
+        if current_type == "code":
+            text = legacy_escape_literal_newlines_fixed(text)
+            result_parts.append(f"```python\n{text}\n```")
+        else:
+            result_parts.append(text)
+        current_block = []
+
+    processed_lines = []
+    for i, line in enumerate(lines):
+        line_type = legacy_is_code_line(line)
+        if line_type is None:
+            prev_type = None
+            next_type = None
+            for j in range(i-1, -1, -1):
+                prev_check = legacy_is_code_line(lines[j])
+                if prev_check is not None:
+                    prev_type = prev_check
+                    break
+            for j in range(i+1, len(lines)):
+                next_check = legacy_is_code_line(lines[j])
+                if next_check is not None:
+                    next_type = next_check
+                    break
+            if prev_type is True and next_type is True:
+                line_type = True
+            else:
+                line_type = False
+        processed_lines.append((line, line_type))
+
+    for line, this_is_code in processed_lines:
+        new_type = "code" if this_is_code else "text"
+        if current_type is None:
+            current_type = new_type
+        if new_type != current_type:
+            flush()
+            current_type = new_type
+        current_block.append(line)
+    flush()
+    return "\n".join(result_parts)
+
+
+# ---------------------------------------------------------------------------
+# 코퍼스
+# ---------------------------------------------------------------------------
+
+SAMPLE_LINES = [
+    "import os",
+    "from collections import defaultdict",
+    "def main(argv):",
+    "    for i in range(10):",
+    "        print(i)",
+    "\tresult = compute(x, y)",
+    "class Parser(object):",
+    "@property",
+    "# 주석입니다",
+    "x = 1",
+    "a, b = b, a",
+    "print('hello')",
+    "foo.bar(baz)",
+    "data = {'key': [1, 2, 3]}",
+    ")",
+    "]",
+    "}, {",
+    'message = "줄바꿈이 들어간 문자열"',
+    "doc = '''여러 줄",
+    "문자열'''",
+    '"""독스트링"""',
+    "안녕하세요, 코드 질문이 있습니다.",
+    "이 함수(예시)가 왜 동작하지 않을까요?",
+    "Here is the traceback I got (see below):",
+    "Traceback (most recent call last):",
+    '  File "app.py", line 12, in <module>',
+    "ValueError: invalid literal for int() with base 10: 'abc'",
+    "2024-05-01 12:00:01 INFO server started on port 8501",
+    "[WARN] cache miss for key=session_42",
+    "결과가 이상하게 나옵니다 [첨부 참고]",
+    "return value",
+    "else:",
+    "그리고 (괄호가 안 닫힌 문장",
+]
+
+
+# 파이썬이 아닌 언어의 예시 (기준 구현은 이 줄들을 텍스트나 python으로 처리하므로 출력 비교에서 제외)
+LANGUAGE_SAMPLES = {
+    "sql": ["SELECT id, name", "FROM users", "WHERE age > 30", "ORDER BY name;", "INSERT INTO logs VALUES (1, 'a');"],
+    "javascript": ["const total = items.reduce((a, b) => a + b, 0);", "let x = 1;", "console.log(total);",
+                   "export default function App() {", "}"],
+    "bash": ["$ pip install streamlit", "git status", "cd /app", "docker compose up -d", "ls"],
+    "yaml": ["name: build", "on: push", "  test:", "    runs-on: ubuntu-latest", "    - uses: actions/checkout@v4"],
+}
+
+# 다른 언어와 같이 쓰는 키워드(if, return, from 등)가 섞인 예시 (언어 감지만 확인)
+LANGUAGE_CASES = [
+    ("javascript", ["function add(a, b) {", "  if (a > b) {", "    return a;", "  }", "  return b;", "}"]),
+    ("javascript", ["import React from 'react';", "class App extends React.Component {", "  render() {",
+                    "    return null;", "  }", "}"]),
+    ("sql", ["select id, name", "from users", "where age > 30", "order by name;"]),
+    ("sql", ["select u.id, count(*) as n from users u", "left join orders o on o.user_id = u.id", "group by u.id;"]),
+    ("python", ["import os", "from pathlib import Path", "def main():", "    if not Path('a').exists():",
+                "        return None", "    for name in os.listdir('.'):", "        print(name)"]),
+]
+
+# 언어 규칙의 첫 단어와 겹치지만 일반 문장인 줄 (코드 블록이 되면 안 됨)
+PROSE_LINES = [
+    "Output:", "Error:", "Note:", "Example:", "note: important",
+    "Select the file from the menu and press OK.", "Insert into the form your name",
+    "AND then it crashed", "let me know what you think", "export 하는 방법", "function 이 뭔가요?",
+    "source code is attached below", "git commit 하는 법을 알려줘",
+]
+
+MIXED_SAMPLE_LINES = SAMPLE_LINES + [line for lines in LANGUAGE_SAMPLES.values() for line in lines]
+
+
+def make_document(rng, n_lines, blank_ratio=0.15, max_blank_run=3, samples=SAMPLE_LINES):
+    lines = []
+    while len(lines) < n_lines:
+        if rng.random() < blank_ratio:
+            lines.extend([""] * rng.randint(1, max_blank_run))
+        else:
+            lines.append(rng.choice(samples))
+    return "\n".join(lines[:n_lines])
+
+
+def make_corpus(seed=0):
+    rng = random.Random(seed)
+    corpus = [
+        "",
+        "\n\n\n",
+        "그냥 문장입니다.",
+        "x = 1\n\n\ny = 2",
+        "설명\n\nimport os\n\n\nprint(os.getcwd())\n\n끝",
+        'text = "a\nb"\nprint(text)',
+        "def f():\n\n    return '''\n여러 줄\n'''\n\n설명 문장",
+        "설명\n\n```python\nx = 1\n\n\ny = 2\n```\n\n- 목록\n\n    이어지는 내용\n끝\r\n~~~\n열린 펜스",
+    ]
+    for n_lines in (5, 20, 80, 300):
+        for _ in range(50):
+            corpus.append(make_document(rng, n_lines))
+    # 빈 줄이 길게 이어지는 입력
+    for _ in range(10):
+        corpus.append(make_document(rng, 300, blank_ratio=0.3, max_blank_run=40))
+    return corpus
+
+
+# ---------------------------------------------------------------------------
+# 실행
+# ---------------------------------------------------------------------------
+
+def check_equivalence(corpus):
+    render = text_code_parser.render_mixed_content.__wrapped__  # lru_cache 우회
+    mismatches = [doc for doc in corpus if render(doc) != legacy_render_mixed_content(doc)]
+    print(f"출력 비교: {len(corpus) - len(mismatches)}/{len(corpus)} 일치")
+    return mismatches
+
+
+def time_call(func, content, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(content)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_line_equivalence(corpus):
+    lines = [line for doc in corpus for line in doc.splitlines()]
+    mismatches = [line for line in lines if text_code_parser.is_code_line(line) != legacy_is_code_line(line)]
+    print(f"줄 분류 비교: {len(lines) - len(mismatches)}/{len(lines)} 일치")
+    escaped = [doc for doc in corpus
+               if text_code_parser.escape_literal_newlines_fixed(doc) != legacy_escape_literal_newlines_fixed(doc)]
+    print(f"문자열 이스케이프 비교: {len(corpus) - len(escaped)}/{len(corpus)} 일치")
+    return mismatches + escaped
+
+
+def split_chunks(rng, text, max_chunk=40):
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, max_chunk)
+        chunks.append(text[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def check_languages():
+    cases = list(LANGUAGE_SAMPLES.items()) + LANGUAGE_CASES
+    mismatches = []
+    for language, lines in cases:
+        output = text_code_parser.render_mixed_content("설명입니다\n" + "\n".join(lines) + "\n끝")
+        if output != f"설명입니다\n```{language}\n" + "\n".join(lines) + "\n```\n끝":
+            mismatches.append(output)
+    print(f"언어 감지: {len(cases) - len(mismatches)}/{len(cases)} 일치")
+    return mismatches
+
+
+def check_prose():
+    render = text_code_parser.render_mixed_content.__wrapped__
+    documents = [f"질문입니다\n{line}\n감사합니다" for line in PROSE_LINES]
+    documents += ["\n".join(PROSE_LINES), "\n\n".join(PROSE_LINES), "Here is my error\nError:\nsomething broke"]
+    mismatches = [doc for doc in documents if render(doc) != doc]
+    print(f"일반 문장 유지: {len(documents) - len(mismatches)}/{len(documents)} 일치")
+    return mismatches
+
+
+def check_incremental(corpus, seed=3):
+    rng = random.Random(seed)
+    render = text_code_parser.render_mixed_content.__wrapped__
+    mismatches = []
+    for doc in corpus:
+        segmenter = text_code_parser.IncrementalSegmenter()
+        markdown = text_code_parser.IncrementalSegmenter(detect_code=False)
+        received = ""
+        ok = True
+        for chunk in split_chunks(rng, doc):
+            segmenter.feed(chunk)
+            markdown.feed(chunk)
+            received += chunk
+            ok = ok and segmenter.render() == render(received)
+        segmenter.close()
+        markdown.close()
+        ok = ok and "\n".join(segmenter.blocks) == render(doc)
+        ok = ok and "\n".join(markdown.blocks) == "\n".join(doc.splitlines())
+        if not ok:
+            mismatches.append(doc)
+    print(f"증분 분할 비교: {len(corpus) - len(mismatches)}/{len(corpus)} 일치")
+    return mismatches
+
+
+def bench_stream(seed=4, n_lines=3000, chunk=20):
+    """델타마다 전체를 다시 렌더링하는 경우와 증분 분할기를 비교 (스트리밍 flush 시뮬레이션)"""
+    rng = random.Random(seed)
+    chunks = split_chunks(rng, make_document(rng, n_lines), max_chunk=chunk)
+    flushes = ["".join(chunks[i:i + 10]) for i in range(0, len(chunks), 10)]  # flush마다 모인 델타
+    render = text_code_parser.render_mixed_content.__wrapped__
+
+    def full(_):
+        received = ""
+        for delta in flushes:
+            received += delta
+            render(received)
+
+    def incremental(_):
+        segmenter = text_code_parser.IncrementalSegmenter()
+        for delta in flushes:
+            segmenter.feed(delta)
+            segmenter.render_tail()
+
+    legacy = time_call(full, None, repeat=1)
+    current = time_call(incremental, None, repeat=1)
+    print(f"{f'스트리밍 {len(flushes)}회 갱신':<28}{legacy * 1000:>10.1f}ms{current * 1000:>10.1f}ms{legacy / current:>7.1f}x")
+
+
+def bench_lines(seed=2, n_lines=20000):
+    rng = random.Random(seed)
+    lines = make_document(rng, n_lines).splitlines()
+    code = "\n".join(line for line in lines if legacy_is_code_line(line))
+
+    def classify(func):
+        return lambda _: [func(line) for line in lines]
+
+    print(f"{'항목':<28}{'기준 구현':>14}{'현재 구현':>14}{'배율':>8}")
+    cases = [
+        ("줄 분류", classify(legacy_is_code_line), classify(text_code_parser.is_code_line), len(lines)),
+        ("문자열 이스케이프", legacy_escape_literal_newlines_fixed,
+         text_code_parser.escape_literal_newlines_fixed, code.count("\n") + 1),
+    ]
+    for name, legacy_func, current_func, count in cases:
+        legacy = time_call(legacy_func, code)
+        current = time_call(current_func, code)
+        print(f"{name:<28}{count / legacy:>10,.0f}줄/s{count / current:>10,.0f}줄/s{legacy / current:>7.1f}x")
+
+
+def bench_render(seed=1):
+    rng = random.Random(seed)
+    render = text_code_parser.render_mixed_content.__wrapped__
+    print(f"{'입력':<28}{'기준 구현':>12}{'현재 구현':>12}{'배율':>8}")
+    cases = [
+        ("1,000줄", make_document(rng, 1000)),
+        ("5,000줄", make_document(rng, 5000)),
+        ("5,000줄 (긴 빈 줄 구간)", make_document(rng, 5000, blank_ratio=0.3, max_blank_run=200)),
+        ("5,000줄 (여러 언어)", make_document(rng, 5000, samples=MIXED_SAMPLE_LINES)),
+    ]
+    for name, content in cases:
+        legacy = time_call(legacy_render_mixed_content, content, repeat=1)
+        current = time_call(render, content)
+        print(f"{name:<28}{legacy * 1000:>10.1f}ms{current * 1000:>10.1f}ms{legacy / current:>7.1f}x")
+
+
+if __name__ == "__main__":
+    corpus = make_corpus()
+    rng = random.Random(5)
+    mixed = [make_document(rng, n_lines, samples=MIXED_SAMPLE_LINES) for n_lines in (5, 20, 80, 300) for _ in range(20)]
+    mismatches = (check_equivalence(corpus) + check_line_equivalence(corpus) + check_languages() + check_prose()
+                  + check_incremental(corpus + mixed))
+    bench_render()
+    bench_stream()
+    bench_lines()
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)}개 입력에서 출력이 다릅니다")
@@ -1,14 +1,51 @@
 import streamlit as st
-from anthropic import Anthropic
+import anthropic
+import httpx
+import bisect
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+import text_code_parser
+import metrics
+import resources
 
 max_input_token=40000
 
-client = Anthropic(api_key=st.secrets['ANTHROPIC_API_KEY'])
+# 사이드바 모델 목록 (과부하 시 선택한 모델 다음 순서로 대체)
+available_models = ["claude-sonnet-4-20250514", "claude-3-7-sonnet-20250219", "claude-opus-4-20250514", "claude-3-opus-20240229", ]
+# 모델별 최대 출력 토큰. 요청의 max_tokens가 더 크면 그 모델로 보낼 때 이 값으로 줄임 (넘으면 400 오류)
+model_max_output_tokens = {
+    "claude-sonnet-4-20250514": 64000,
+    "claude-3-7-sonnet-20250219": 64000,
+    "claude-opus-4-20250514": 32000,
+    "claude-3-opus-20240229": 4096,
+}
 
-def claude_stream_generator(response_stream):
-    """Claude API의 스트리밍 응답을 텍스트 제너레이터로 변환합니다."""
+client = None  # 연결 풀을 공유하는 프로세스 단일 클라이언트 (첫 API 호출 때 만듦)
+
+def get_client():
+    # import 시점에 만들지 않으므로 API를 쓰지 않는 도구(archive.py 등)는 ANTHROPIC_API_KEY 없이 이 모듈을 쓸 수 있음
+    global client
+    if client is None:
+        client = resources.get_anthropic_client()
+    return client
+
+def claude_stream_generator(response_stream, usage=None):
+    """Claude API의 스트리밍 응답을 텍스트 제너레이터로 변환합니다.
+    usage dict가 주어지면 message_start/message_delta 이벤트의 토큰 사용량을 기록합니다."""
     for chunk in response_stream:
         if hasattr(chunk, 'type'):
+            if usage is not None:
+                if chunk.type == 'message_start' and getattr(chunk.message, 'usage', None):
+                    usage['input_tokens'] = chunk.message.usage.input_tokens
+                    usage['cache_read_input_tokens'] = getattr(chunk.message.usage, 'cache_read_input_tokens', None) or 0
+                    usage['cache_creation_input_tokens'] = getattr(chunk.message.usage, 'cache_creation_input_tokens', None) or 0
+                elif chunk.type == 'message_delta' and getattr(chunk, 'usage', None):
+                    usage['output_tokens'] = chunk.usage.output_tokens
             # content_block_delta 이벤트 처리
             if chunk.type == 'content_block_delta' and hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
                 yield chunk.delta.text
@@ -23,7 +60,7 @@ def get_preview_with_claude(messages):
     prompt = f"""다음 대화의 제목을 한글 10자 이내 또는 영어 20자 이내로 작성하세요. 제목만 출력하고 다른 텍스트는 절대 포함하지 마세요. 
                {message_in_string}
               제목:"""
-    response = client.messages.create(
+    response = get_client().messages.create(
         model="claude-sonnet-4-20250514",
         max_tokens=64,
         temperature=0.2,
@@ -31,52 +68,525 @@ def get_preview_with_claude(messages):
     )
     return response.content[0].text.strip().split('\n')[0]
 
-#입력 토큰 카운팅
-def count_token(model, system, messages):
-    response = client.messages.count_tokens(
-        model=model,
-        system=system,
-        messages=messages,
-    )
-    return int(dict(response)['input_tokens'])
+# 로컬 토큰 추정: API 실측값(usage.input_tokens)으로 token_scale을 보정합니다
+token_scale = 1.0
+message_token_overhead = 4  # role 등 메시지 단위 부가 토큰
+
+def estimate_tokens(text):
+    """ASCII 약 4자당 1토큰, 그 외(한글 등) 1자당 1토큰으로 추정한 뒤 보정 계수를 곱합니다."""
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    other_chars = len(text) - ascii_chars
+    return int((ascii_chars / 4 + other_chars) * token_scale) + 1
+
+def calibrate_token_scale(estimated_tokens, actual_tokens):
+    """실제 입력 토큰 수와 추정치의 비율로 보정 계수를 서서히 조정합니다."""
+    global token_scale
+    if estimated_tokens <= 0 or actual_tokens <= 0:
+        return
+    ratio = actual_tokens / estimated_tokens
+    token_scale = min(4.0, max(0.25, token_scale * (1 + 0.5 * (ratio - 1))))
+
+def message_tokens(message):
+    """메시지별 토큰 수. 메시지에 num_tokens로 캐시되어 새로 추가/편집된 메시지만 계산합니다."""
+    if 'num_tokens' not in message:
+        message['num_tokens'] = estimate_tokens(message['content']) + message_token_overhead
+    return message['num_tokens']
+
+def token_prefix_sums(messages):
+    """prefix[i] = messages[:i]의 토큰 합. 같은 리스트에 메시지가 추가되면 새 메시지만 누적합니다."""
+    cached = st.session_state.get('token_prefix')
+    if cached is None or cached[0] is not messages or len(cached[1]) - 1 > len(messages):
+        cached = (messages, [0])
+        st.session_state.token_prefix = cached
+    prefix = cached[1]
+    for message in messages[len(prefix) - 1:]:
+        prefix.append(prefix[-1] + message_tokens(message))
+    return prefix
+
+def fit_suffix(messages, prefix, start, budget):
+    """prefix[n] - prefix[k] <= budget을 만족하는 가장 작은 k(user 메시지에서 시작)를 이분 탐색으로 찾습니다.
+    마지막 user 메시지보다 뒤에서 시작하지 않으므로 최신 질문은 항상 포함됩니다."""
+    n = len(messages)
+    last_user = n - 1
+    while last_user > start and messages[last_user]["role"] != "user":
+        last_user -= 1
+
+    k = bisect.bisect_left(prefix, prefix[n] - budget, start, last_user)
+    # 대화가 user 메시지로 시작하도록 앞으로 이동
+    while k < last_user and messages[k]["role"] != "user":
+        k += 1
+    return k
 
+def truncate_messages(messages, system_prompt, max_tokens=max_input_token, summary=None):
+    """메시지별 토큰 누적합으로 예산 안에 들어가는 가장 긴 최근 대화 구간을 찾고 실제 토큰 수를 반환합니다.
+    요약이 있으면 요약을, 없으면 첫 user 턴(질문+응답)을 가능하면 고정해서 유지합니다."""
+    with metrics.span('count_token'):  # 입력 토큰 계산(추정 + 누적합 + 구간 탐색)에 걸린 시간
+        return _truncate_messages(messages, system_prompt, max_tokens, summary)
 
-def truncate_messages(messages, system_prompt, max_tokens=max_input_token):
-    """토큰 사용량 추산을 통해 효율적으로 대화 길이 제한"""
+def _truncate_messages(messages, system_prompt, max_tokens, summary):
     if len(messages) == 0:
-        return messages
+        return messages, 0
 
-    # 현재 전체 토큰 수 계산
-    current_tokens = count_token("claude-sonnet-4-20250514", system_prompt, messages)
+    prefix = token_prefix_sums(messages)
+    n = len(messages)
+    system_tokens = estimate_tokens(system_prompt)
 
     # 토큰 수가 제한 이하면 전체 반환
-    if current_tokens <= max_tokens:
-        return messages, current_tokens
+    if system_tokens + prefix[n] <= max_tokens:
+        return messages, system_tokens + prefix[n]
 
-    # 토큰 수가 초과하면 비례적으로 대화 수 줄이기
-    total_conversations = len(messages) // 2  # user+assistant 쌍의 개수
-    if total_conversations == 0:
-        return messages, current_tokens
+    # 고정 구간: 요약(이미 요약된 메시지는 건너뜀) 또는 첫 user 턴
+    if summary and summary["upto"] < n:
+        pinned, start = summary_messages(summary), summary["upto"]
+    elif n > 2 and messages[0]["role"] == "user" and messages[1]["role"] == "assistant":
+        pinned, start = messages[:2], 2
+    else:
+        pinned, start = [], 0
 
-    # 유지할 대화 수 계산 (최소 1개는 보장)
-    keep_conversations = max(1, int(total_conversations * (max_tokens / current_tokens)))
+    # 고정 구간까지 넣으면 최신 질문이 들어가지 않을 때는 고정 해제
+    while True:
+        pinned_tokens = sum(message_tokens(m) for m in pinned)
+        budget = max_tokens - system_tokens - pinned_tokens
+        k = fit_suffix(messages, prefix, start, budget)
+        num_tokens = system_tokens + pinned_tokens + prefix[n] - prefix[k]
+        if num_tokens <= max_tokens or not pinned:
+            break
+        pinned = []
 
-    # 최근 N개 대화만 유지 (user+assistant 쌍 단위)
-    keep_messages_count = keep_conversations * 2
-    truncated_messages = messages[-keep_messages_count:]
-    return truncated_messages, int(current_tokens * (max_tokens / current_tokens))
-        
+    return pinned + messages[k:], num_tokens
+
+# 대화 요약: 요약되지 않은 구간이 예산의 일정 비율을 넘으면 오래된 턴을 요약으로 접습니다
+summary_model = "claude-3-5-haiku-20241022"
+summary_trigger_ratio = 0.75  # 요약되지 않은 구간이 예산의 75%를 넘으면 요약 갱신
+summary_keep_ratio = 0.4      # 요약 후 원문 그대로 남겨둘 최근 구간 (예산 대비)
+summary_chunk_tokens = max_input_token  # 한 번에 요약하는 최대 분량. 남은 구간은 다음 턴에서 이어서 접음
+
+_summary_results = {}      # session_id -> 백그라운드에서 완료된 요약
+_summary_inflight = set()  # 요약 생성 중인 session_id
+_summary_lock = threading.Lock()
 
-def generate_claude_response(model, temperature, system_prompt):
-    messages = [
-        {"role": m["role"], "content": m["content"]}
-        for m in st.session_state.messages
+def summary_messages(summary):
+    """요약을 대화 맨 앞에 고정할 user/assistant 메시지 쌍으로 변환합니다."""
+    return [
+        {"role": "user", "content": f"[이전 대화 요약]\n{summary['content']}", "num_tokens": summary["num_tokens"]},
+        {"role": "assistant", "content": "이전 대화 요약을 참고해서 이어서 답변하겠습니다."},
     ]
-    truncated_messages, num_input_tokens = truncate_messages(messages, system_prompt, max_tokens=max_input_token)
-    st.session_state.num_input_tokens = num_input_tokens
+
+def summarize_messages(previous_summary, messages):
+    conversation = "\n\n".join(f"[{m['role']}]\n{m['content']}" for m in messages)
+    previous = f"기존 요약:\n{previous_summary}\n\n" if previous_summary else ""
+
+    prompt = f"""다음은 사용자와 AI의 이전 대화입니다. 이후 대화를 이어가는 데 필요한 사실, 결정 사항, 사용자의 요구사항, 코드와 파일의 핵심 내용을 빠짐없이 간결하게 요약하세요. 기존 요약이 있으면 그 내용도 포함해서 하나의 요약으로 작성하세요. 요약만 출력하세요.
+{previous}대화:
+{conversation}"""
+    response = get_client().messages.create(
+        model=summary_model,
+        max_tokens=2048,
+        temperature=0,
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return response.content[0].text.strip()
+
+def _compact_worker(session_id, previous_summary, messages, upto):
+    try:
+        content = summarize_messages(previous_summary["content"] if previous_summary else None, messages)
+        result = {"content": content, "upto": upto, "num_tokens": estimate_tokens(content) + message_token_overhead}
+        with _summary_lock:
+            _summary_results[session_id] = result
+        print(f"대화 요약 완료: {session_id} (메시지 {upto}개)")
+    except Exception as e:
+        print(f"대화 요약 오류: {str(e)}")
+    finally:
+        with _summary_lock:
+            _summary_inflight.discard(session_id)
+
+def maybe_compact(session_id, messages, summary):
+    """요약되지 않은 구간이 임계치를 넘으면 워터마크 이전 턴의 요약을 백그라운드에서 갱신합니다."""
+    start = summary["upto"] if summary else 0
+    prefix = token_prefix_sums(messages)
+    if prefix[len(messages)] - prefix[start] <= max_input_token * summary_trigger_ratio:
+        return
+
+    # 최근 구간만 원문으로 남기는 워터마크 (user 메시지 경계)
+    upto = fit_suffix(messages, prefix, start, int(max_input_token * summary_keep_ratio))
+    if upto <= start:
+        return
+    # 요약 없이 불러온 긴 세션도 요약 모델의 입력 한도를 넘지 않도록 한 번에 summary_chunk_tokens까지만
+    # (user 메시지 경계로 내리되, 경계가 하나도 들어가지 않으면 첫 경계까지)
+    limit = bisect.bisect_right(prefix, prefix[start] + summary_chunk_tokens, start, upto + 1) - 1
+    chunk_end = limit
+    while chunk_end > start and messages[chunk_end]["role"] != "user":
+        chunk_end -= 1
+    if chunk_end <= start:
+        chunk_end = start + 1
+        while chunk_end < upto and messages[chunk_end]["role"] != "user":
+            chunk_end += 1
+    upto = chunk_end
+
+    with _summary_lock:
+        if session_id in _summary_inflight:
+            return
+        _summary_inflight.add(session_id)
+    threading.Thread(
+        target=_compact_worker,
+        args=(session_id, summary, [{"role": m["role"], "content": m["content"]} for m in messages[start:upto]], upto),
+        daemon=True,
+    ).start()
+
+def collect_summary(session_id):
+    """백그라운드에서 완료된 요약이 있으면 세션 상태에 반영합니다."""
+    with _summary_lock:
+        result = _summary_results.pop(session_id, None)
+    current = st.session_state.get('summary')
+    if result and result["upto"] <= len(st.session_state.messages) and (not current or result["upto"] > current["upto"]):
+        st.session_state.summary = result
+    return st.session_state.get('summary')
+
+def invalidate_summary(session_id, index):
+    """index 위치의 메시지가 편집되면 그 메시지를 포함한 요약은 버립니다."""
+    summary = st.session_state.get('summary')
+    if summary and summary["upto"] > index:
+        st.session_state.summary = None
+    with _summary_lock:
+        result = _summary_results.get(session_id)
+        if result and result["upto"] > index:
+            del _summary_results[session_id]
+        
+
+class StreamRenderer:
+    """스트리밍 델타를 리스트 버퍼에 모았다가 시간(기본 50ms) 또는 크기(기본 2KB) 기준으로 한 번에 그립니다.
+    델타마다 문자열을 다시 만들고 markdown을 보내는 비용(응답 길이의 제곱)을 피합니다.
+    응답은 코드 펜스/문단 단위 블록으로 나눠서, 확정된 블록은 한 번만 그리고 마지막 블록만 다시 그립니다."""
+
+    def __init__(self, placeholder, interval=0.05, max_pending=2048):
+        self.placeholder = placeholder
+        self.area = placeholder.container()
+        self.slot = self.area.empty()  # 아직 확정되지 않은 마지막 블록을 그리는 자리
+        self.interval = interval
+        self.max_pending = max_pending
+        self.parts = []          # 아직 그리지 않은 델타
+        self.pending_size = 0
+        self.text = ""           # 지금까지 받은 전체 텍스트
+        self.segmenter = text_code_parser.IncrementalSegmenter(detect_code=False)
+        self.drawn = 0           # 그린 확정 블록 수
+        self.last_flush = time.monotonic()
+
+    def feed(self, delta):
+        self.parts.append(delta)
+        self.pending_size += len(delta)
+        if self.pending_size >= self.max_pending or time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def _collect(self):
+        if self.parts:
+            delta = "".join(self.parts)
+            self.text += delta
+            self.segmenter.feed(delta)
+            self.parts = []
+            self.pending_size = 0
+
+    def _draw(self):
+        # 새로 확정된 블록은 현재 자리에 고정하고 다음 블록을 위한 자리를 새로 만듦
+        blocks = self.segmenter.blocks
+        while self.drawn < len(blocks):
+            self.slot.markdown(blocks[self.drawn])
+            self.slot = self.area.empty()
+            self.drawn += 1
+        self.slot.markdown(self.segmenter.render_tail())
+
+    def flush(self):
+        self._collect()
+        self._draw()
+        self.last_flush = time.monotonic()
+
+    def finish(self):
+        """남은 델타를 합쳐 전체 텍스트를 반환합니다.
+        블록별로 나눠 그린 영역은 완성된 답변 하나의 markdown으로 바꿔서, 블록 경계(목록/인용 등이
+        문단 사이에 걸친 경우)와 관계없이 대화 기록을 다시 그릴 때와 같은 모양이 되도록 합니다."""
+        self._collect()
+        self.placeholder.markdown(self.text)
+        return self.text
+
+def build_cached_request(system_prompt, messages):
+    """시스템 프롬프트와 마지막 메시지에 캐시 지점(cache_control)을 표시합니다.
+    마지막 메시지까지의 prefix는 다음 턴에서 그대로 재사용되어 캐시에서 읽힙니다."""
+    system = system_prompt
+    if system_prompt.strip():
+        system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+
+    request_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+    if request_messages and request_messages[-1]["content"]:
+        last = request_messages[-1]
+        last["content"] = [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+    return system, request_messages
+
+# 응답 생성 작업: 워커 스레드가 per-session 큐에 델타를 넣고, 스크립트 실행은 큐를 비우며 그리기만 합니다.
+# 스크립트가 재실행(사이드바 클릭 등)되어도 생성은 계속되고, 다음 실행이 같은 작업을 이어서 그립니다.
+_generation_jobs = {}  # session_id -> 작업 dict
+_generation_lock = threading.Lock()
+generation_job_ttl = 3600  # 아무도 가져가지 않은 완료 작업 보관 시간 (초)
+
+# 재시도 정책: 지수 백오프(full jitter), retry-after 헤더 우선
+max_retries = 4
+retry_base_delay = 1.0
+retry_max_delay = 30.0
+
+def classify_error(e):
+    """SDK 예외를 'overloaded'(다른 모델로 대체), 'retryable'(백오프 후 재시도), 'fatal'(즉시 실패)로 분류합니다."""
+    if isinstance(e, anthropic.APIStatusError):
+        error = e.body.get('error') if isinstance(e.body, dict) else None
+        error_type = error.get('type') if isinstance(error, dict) else None
+        if e.status_code == 529 or error_type == 'overloaded_error':
+            return 'overloaded'
+        if (isinstance(e, (anthropic.RateLimitError, anthropic.InternalServerError)) or
+            e.status_code in (408, 409, 429) or e.status_code >= 500 or
+            error_type in ('rate_limit_error', 'api_error')):
+            return 'retryable'
+        return 'fatal'
+    if isinstance(e, anthropic.APIConnectionError):  # 타임아웃 포함
+        return 'retryable'
+    # 스트리밍 중 연결이 끊기면 SDK가 감싸지 않은 httpx 예외가 그대로 올라옴 (ReadError, RemoteProtocolError, ReadTimeout 등)
+    if isinstance(e, httpx.TransportError):
+        return 'retryable'
+    return 'fatal'
+
+def retry_delay(attempt, e):
+    """retry-after 헤더가 있으면 그 값을, 없으면 지수 백오프 범위 안의 무작위 지연을 사용합니다."""
+    response = getattr(e, 'response', None)
+    if response is not None:
+        try:
+            if response.headers.get('retry-after-ms'):
+                return min(retry_max_delay, float(response.headers['retry-after-ms']) / 1000)
+            if response.headers.get('retry-after'):
+                return min(retry_max_delay, float(response.headers['retry-after']))
+        except ValueError:
+            pass
+    return random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+
+def _generation_worker(job, request):
+    """응답을 생성합니다. 스트림이 중간에 끊기면 받은 부분을 assistant prefill로 넘겨 이어서 생성합니다."""
+    # 목록에서 선택한 모델 다음에 있는 모델만 순서대로 대체 후보
+    fallback_models = available_models[available_models.index(request['model']) + 1:] if request['model'] in available_models else []
+    received = []  # 큐에 넣은 전체 텍스트
+    attempt = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            max_tokens = min(request['max_tokens'], model_max_output_tokens.get(job['model'], request['max_tokens']))
+            attempt_request = dict(request, model=job['model'], max_tokens=max_tokens)
+            partial = "".join(received).rstrip()  # prefill은 공백으로 끝날 수 없음
+            if partial:
+                attempt_request['messages'] = request['messages'] + [{"role": "assistant", "content": partial}]
+                job['resumed'] = True
+            try:
+                # 재시도는 여기서 직접 관리하므로 SDK 자동 재시도는 끔
+                response = get_client().with_options(max_retries=0).messages.create(**attempt_request, stream=True)
+                for text in claude_stream_generator(response, job['usage']):
+                    if job['cancelled'].is_set():  # 대화가 바뀌어 버려진 작업
+                        response.close()
+                        return
+                    if job['ttft'] is None:  # 첫 토큰까지 걸린 시간 (재시도 대기 포함)
+                        job['ttft'] = time.perf_counter() - started
+                        metrics.record('ttft', job['ttft'])
+                    received.append(text)
+                    job['queue'].put(text)
+                job['stream_seconds'] = time.perf_counter() - started
+                metrics.record('stream', job['stream_seconds'])
+                break
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == 'fatal' or attempt >= max_retries:
+                    raise
+                if kind == 'overloaded' and fallback_models:
+                    job['model'] = fallback_models.pop(0)
+                    print(f"{attempt_request['model']} 과부하, {job['model']} 모델로 재시도")
+                else:
+                    delay = retry_delay(attempt, e)
+                    print(f"응답 생성 오류({type(e).__name__}), {delay:.1f}초 후 재시도")
+                    time.sleep(delay)
+                attempt += 1
+    except Exception as e:
+        job['error'] = e
+    finally:
+        job['finished_at'] = time.time()
+        job['done'].set()
+
+def start_generation(session_id, request, num_input_tokens, summary, message_count):
+    """세션의 응답 생성 작업을 시작합니다. 이미 진행 중인 작업이 있으면 그 작업을 반환합니다."""
+    with _generation_lock:
+        now = time.time()
+        for key in [k for k, j in _generation_jobs.items() if j['done'].is_set() and now - j['finished_at'] > generation_job_ttl]:
+            del _generation_jobs[key]
+        if session_id in _generation_jobs:
+            return _generation_jobs[session_id]
+
+        job = {
+            'queue': queue.Queue(),
+            'parts': [],  # 지금까지 화면으로 가져간 델타
+            'usage': {},
+            'error': None,
+            'done': threading.Event(),
+            'finished_at': None,
+            'model': request['model'],
+            'resumed': False,  # 끊긴 스트림을 이어서 생성했는지 여부
+            'num_input_tokens': num_input_tokens,
+            'summary': summary,
+            'ttft': None,            # 첫 토큰까지 걸린 시간 (초)
+            'stream_seconds': None,  # 응답 완료까지 걸린 시간 (초)
+            'message_count': message_count,  # 요청을 만들 때의 메시지 수 (대화가 바뀌었는지 확인용)
+            'cancelled': threading.Event(),
+        }
+        _generation_jobs[session_id] = job
+    threading.Thread(target=_generation_worker, args=(job, request), daemon=True).start()
+    return job
+
+def get_generation(session_id):
+    with _generation_lock:
+        return _generation_jobs.get(session_id)
+
+def has_generation(session_id):
+    return get_generation(session_id) is not None
+
+def _remove_generation(session_id, job):
+    with _generation_lock:
+        if _generation_jobs.get(session_id) is job:
+            del _generation_jobs[session_id]
+
+def cancel_generation(session_id):
+    """메시지 편집/새 입력으로 대화가 바뀌었을 때 진행 중인 작업을 버립니다. (워커는 다음 델타에서 멈춤)"""
+    with _generation_lock:
+        job = _generation_jobs.pop(session_id, None)
+    if job is not None:
+        job['cancelled'].set()
+
+def drain_generation(job, renderer):
+    """작업 큐를 비우면서 렌더러로 그립니다. 이전 실행에서 가져간 델타부터 다시 그립니다."""
+    if job['parts']:
+        renderer.feed("".join(job['parts']))
+    while True:
+        try:
+            text = job['queue'].get(timeout=renderer.interval)
+        except queue.Empty:
+            if job['done'].is_set() and job['queue'].empty():
+                break
+            # 델타가 없어도(첫 토큰 대기, 재시도 대기) 매번 그려서 스크립트 스레드가 st 호출을 하도록 함:
+            # 사이드바 클릭 등으로 요청된 rerun은 st 호출 시점에만 처리되므로, 그리지 않으면 응답이 끝날 때까지 밀림
+            renderer.flush()
+            continue
+        job['parts'].append(text)
+        renderer.feed(text)
+
+# 응답 캐시: 같은 모델/온도/시스템 프롬프트/잘린 메시지 목록이면 저장된 답변을 그대로 재생
+# (temperature 0이거나 사용자가 켰을 때만 사용). 메모리 LRU + 선택적으로 Firestore에 보관
+response_cache_size = 200
+response_cache_persist = True  # Firestore(conversations/{email}/response_cache)에도 저장
+response_cache_replay_chunk = 200  # 재생 시 렌더러에 넣는 조각 크기 (글자)
+_response_cache = OrderedDict()  # (user_email, key) -> {'content', 'model', 'num_tokens'}
+_response_cache_lock = threading.Lock()
+
+def response_cache_key(request):
+    payload = {k: request[k] for k in ('model', 'temperature', 'system', 'messages')}
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _response_cache_ref(db, user_email, key):
+    return db.collection('conversations').document(user_email).collection('response_cache').document(key)
+
+def get_cached_response(db, user_email, key):
+    with _response_cache_lock:
+        entry = _response_cache.get((user_email, key))
+        if entry is not None:
+            _response_cache.move_to_end((user_email, key))
+            return entry
+    if db is None or not response_cache_persist:
+        return None
+    try:
+        doc = _response_cache_ref(db, user_email, key).get()
+    except Exception as e:
+        print(f"응답 캐시 읽기 실패: {e}")
+        return None
+    if not doc.exists:
+        return None
+    data = doc.to_dict()
+    entry = {'content': data['content'], 'model': data.get('model'), 'num_tokens': data.get('num_tokens')}
+    _remember_response(user_email, key, entry)
+    return entry
+
+def _remember_response(user_email, key, entry):
+    with _response_cache_lock:
+        _response_cache[(user_email, key)] = entry
+        _response_cache.move_to_end((user_email, key))
+        while len(_response_cache) > response_cache_size:
+            _response_cache.popitem(last=False)
+
+def store_cached_response(db, user_email, key, entry):
+    _remember_response(user_email, key, entry)
+    if db is None or not response_cache_persist:
+        return
+
+    def write():
+        try:
+            _response_cache_ref(db, user_email, key).set(dict(entry, created_at=time.time()))
+        except Exception as e:  # 1MB를 넘는 답변 등은 메모리 캐시에만 남음
+            print(f"응답 캐시 저장 실패: {e}")
+    threading.Thread(target=write, daemon=True).start()
+
+def start_cached_generation(session_id, entry, num_input_tokens, summary, message_count):
+    """캐시된 답변을 이미 끝난 생성 작업으로 만들어 일반 응답과 같은 경로(drain_generation)로 그립니다."""
+    job = {
+        'queue': queue.Queue(),
+        'parts': [],
+        'usage': {},
+        'error': None,
+        'done': threading.Event(),
+        'finished_at': time.time(),
+        'model': entry['model'],
+        'resumed': False,
+        'num_input_tokens': num_input_tokens,
+        'summary': summary,
+        'ttft': None,
+        'stream_seconds': None,
+        'message_count': message_count,
+        'cancelled': threading.Event(),
+        'cached': entry,  # 재생 중인 캐시 항목
+    }
+    content = entry['content']
+    for i in range(0, len(content), response_cache_replay_chunk):
+        job['queue'].put(content[i:i + response_cache_replay_chunk])
+    job['done'].set()
+    with _generation_lock:
+        _generation_jobs[session_id] = job
+    return job
+
+def generate_claude_response(model, temperature, system_prompt, use_cache=False, db=None):
+    session_id = st.session_state.session_id
+    user_email = st.session_state.get('user_email') or 'anonymous'
+    job = get_generation(session_id)
+    if job is not None and job['message_count'] != len(st.session_state.messages):
+        # 다른 대화 상태(편집 전 메시지 등)에 대한 작업은 버리고 새로 생성
+        cancel_generation(session_id)
+        job = None
+    if job is None:
+        summary = collect_summary(session_id)
+        truncated_messages, num_input_tokens = truncate_messages(st.session_state.messages, system_prompt, max_tokens=max_input_token, summary=summary)
+        system, truncated_messages = build_cached_request(system_prompt, truncated_messages)
+        st.session_state.num_input_tokens = num_input_tokens
+        request = {
+            'model': model,
+            'messages': truncated_messages,
+            'temperature': temperature,
+            'max_tokens': 64000,
+            'system': system,
+        }
+        cache_key = response_cache_key(request) if use_cache else None
+        cached = get_cached_response(db, user_email, cache_key) if cache_key else None
+        if cached is not None:
+            job = start_cached_generation(session_id, cached, num_input_tokens, summary, len(st.session_state.messages))
+        else:
+            job = start_generation(session_id, request, num_input_tokens, summary, len(st.session_state.messages))
+        job['cache_key'] = cache_key
     
     try:
-        # API 호출
+        # 응답 표시
         with st.spinner("Claude가 응답 중..."):
             # 새로운 chat_message 컨테이너 생성
             with st.chat_message("assistant"):
@@ -84,42 +594,67 @@ def generate_claude_response(model, temperature, system_prompt):
                 response_placeholder = st.empty()
                 response_placeholder.markdown("")
                 
-                response = client.messages.create(
-                    model=model,
-                    messages=truncated_messages,
-                    temperature=temperature,
-                    max_tokens=64000,
-                    system=system_prompt,
-                    stream=True
-                )
-                
-                # 응답 스트리밍
-                full_response = ""
-                for text in claude_stream_generator(response):
-                    full_response += text
-                    # 응답 업데이트
-                    response_placeholder.markdown(full_response)
+                # 응답 스트리밍 (작업 큐에서 일정 간격으로 모아서 업데이트)
+                renderer = StreamRenderer(response_placeholder)
+                drain_generation(job, renderer)
+                full_response = renderer.finish()
+                _remove_generation(session_id, job)
+                if job['error'] is not None:
+                    raise job['error']
+                usage = job['usage']
             
-                # 메시지 기록에 추가
-                st.session_state.messages.append({"role": "assistant", "content": full_response})
+                # 메시지 기록에 추가 (출력 토큰 수는 실측값을 그대로 캐시)
+                assistant_message = {"role": "assistant", "content": full_response}
+                if 'output_tokens' in usage and not job['resumed']:
+                    assistant_message['num_tokens'] = usage['output_tokens'] + message_token_overhead
+                elif job.get('cached') and job['cached'].get('num_tokens'):
+                    assistant_message['num_tokens'] = job['cached']['num_tokens']
+                st.session_state.messages.append(assistant_message)
+
+                # 새로 생성한 답변은 응답 캐시에 저장
+                if job.get('cache_key') and not job.get('cached'):
+                    store_cached_response(db, user_email, job['cache_key'], {
+                        'content': full_response,
+                        'model': job['model'],
+                        'num_tokens': assistant_message.get('num_tokens'),
+                    })
+
+                # 실제 입력 토큰 수로 표시값 갱신 및 추정기 보정
+                if 'input_tokens' in usage:
+                    total_input_tokens = usage['input_tokens'] + usage['cache_read_input_tokens'] + usage['cache_creation_input_tokens']
+                    if not job['resumed']:  # prefill이 붙은 재시도는 추정치와 비교할 수 없음
+                        calibrate_token_scale(job['num_input_tokens'], total_input_tokens)
+                    st.session_state.num_input_tokens = total_input_tokens
+                    st.session_state.cache_read_tokens = usage['cache_read_input_tokens']
+                    st.session_state.cache_creation_tokens = usage['cache_creation_input_tokens']
+
+                # 턴별 토큰/지연 시간 기록
+                metrics.record_turn(
+                    job['model'],
+                    input_tokens=usage.get('input_tokens', 0),
+                    output_tokens=usage.get('output_tokens', 0),
+                    cache_read_tokens=usage.get('cache_read_input_tokens', 0),
+                    cache_creation_tokens=usage.get('cache_creation_input_tokens', 0),
+                    ttft=job['ttft'],
+                    stream_seconds=job['stream_seconds'],
+                    cached=bool(job.get('cached')),
+                )
+
+                # 오래된 턴 요약 (백그라운드)
+                maybe_compact(session_id, st.session_state.messages, job['summary'])
+
+                if job.get('cached'):
+                    st.caption("같은 요청에 대해 저장된 답변을 표시했습니다.")
+                elif job['model'] != model:
+                    st.caption(f"{model} 모델이 과부하 상태여서 {job['model']} 모델로 응답했습니다.")
                 
         # 응답 생성 완료
         st.session_state.generating_response = False
 
     except Exception as e:
-        # 재시도 불가능한 명확한 오류들
-        error_str = str(e)
-        if ('overloaded_error' in error_str or 
-            'rate_limit' in error_str or 
-            'authentication' in error_str or
-            'permission' in error_str):
-            if 'overloaded_error' in error_str:
-                st.error("이런, Anthropic 서버가 죽어있네요😞 잠시 후 다시 시도하거나 다른 모델을 사용해 주세요")
-            else:
-                st.error(f"오류가 발생했습니다: {str(e)}")
-            st.session_state.generating_response = False
+        # 재시도 불가능한 오류이거나 재시도 횟수 초과
+        if classify_error(e) == 'overloaded':
+            st.error("이런, Anthropic 서버가 죽어있네요😞 잠시 후 다시 시도하거나 다른 모델을 사용해 주세요")
         else:
-            # 재시도 가능한 오류 - 플래그 유지하고 조용히 실패
-            # 상위에서 재검증 로직이 재시도할 것임
-            pass
-        
+            st.error(f"오류가 발생했습니다: {str(e)}")
+        st.session_state.generating_response = False
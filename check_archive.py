@@ -0,0 +1,100 @@
+"""
+archive.py 백업/복원 왕복 확인 (Firestore 에뮬레이터 필요)
+
+    gcloud emulators firestore start --host-port=localhost:8080
+    FIRESTORE_EMULATOR_HOST=localhost:8080 python check_archive.py
+
+예시 세션(blob으로 분리되는 큰 본문, 세션 사이에 겹치는 본문, 조각으로 나눠 저장되는 아주 큰 본문 포함)을 아카이브로 만들어 복원하고,
+다시 내보낸 결과가 원래 세션과 같은지, 그 결과를 다른 사용자로 복원해 내보내도 같은지 확인합니다.
+실행할 때마다 새 사용자 이메일을 쓰므로 에뮬레이터의 기존 데이터와 섞이지 않습니다.
+"""
+import gzip
+import json
+import os
+import random
+import string
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import archive
+import history
+
+
+def make_sessions(n_sessions=12):
+    shared = "공유되는 긴 본문입니다.\n" * 400  # 여러 세션에 같은 blob
+    started = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    sessions = []
+    for k in range(n_sessions):
+        messages = []
+        for turn in range(k % 4 + 1):
+            question = f"질문 {k}-{turn}: 파이썬에서 docker 설정하는 방법"
+            answer = shared if turn == 1 else f"답변 {k}-{turn}\n\n```python\nx = {turn}\n```" + "가나다" * (k * 500)
+            messages.append({'role': 'user', 'content': question, 'num_tokens': 20 + turn})
+            messages.append({'role': 'assistant', 'content': answer, 'num_tokens': 100 + k})
+        header = {'preview': f"세션 {k}", 'updated_at': started + timedelta(minutes=k),
+                  'user_name': 'archive check', 'summary': None}
+        sessions.append({'type': 'session', 'session_id': f"check-{k:03d}", 'header': header, 'messages': messages})
+    # 압축해도 문서 한도(1MiB)를 넘는 본문: 여러 조각 문서로 나눠 저장
+    large = "".join(random.Random(0).choices(string.ascii_letters + string.digits + "가나다라", k=3 * 1024 * 1024))
+    sessions.append({'type': 'session', 'session_id': "check-large", 'header': dict(header, preview="큰 세션"),
+                     'messages': [{'role': 'user', 'content': "긴 로그", 'num_tokens': 10},
+                                  {'role': 'assistant', 'content': large, 'num_tokens': 1000}]})
+    return sessions
+
+
+def write_archive(path, user_email, sessions):
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'type': 'archive', 'version': archive.archive_version, 'user_email': user_email,
+                            'exported_at': datetime.now().isoformat(), 'sessions': len(sessions)}) + "\n")
+        for record in sessions:
+            f.write(json.dumps(record, ensure_ascii=False, default=archive._encode) + "\n")
+
+
+def read_sessions(path):
+    # 복원하면서 채워지는 필드(user_email 등)는 비교에서 제외
+    sessions = {}
+    for record in archive._read_archive(path):
+        if record['type'] == 'session':
+            header = {k: v for k, v in record['header'].items() if k not in ('user_email', 'session_id', 'message_count')}
+            sessions[record['session_id']] = (header, record['messages'])
+    return sessions
+
+
+def compare(name, expected, actual):
+    mismatches = [session_id for session_id in expected if expected[session_id] != actual.get(session_id)]
+    mismatches += [session_id for session_id in actual if session_id not in expected]
+    print(f"{name}: {len(expected) - len(mismatches)}/{len(expected)} 일치")
+    return mismatches
+
+
+if __name__ == "__main__":
+    if not os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        raise SystemExit("FIRESTORE_EMULATOR_HOST를 설정하고 Firestore 에뮬레이터에서 실행하세요")
+    db = archive.connect()
+    run_id = time.strftime('%Y%m%d%H%M%S')
+    source_user, copy_user = f"check-{run_id}@example.com", f"check-copy-{run_id}@example.com"
+    sessions = make_sessions()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source, exported, copied = (os.path.join(tmp, name) for name in ('source.ndjson.gz', 'export.ndjson.gz', 'copy.ndjson.gz'))
+        write_archive(source, source_user, sessions)
+        expected = read_sessions(source)
+
+        archive.import_user_archive(db, source, source_user)
+        archive.export_user_archive(db, source_user, exported)
+        mismatches = compare("복원 후 내보내기", expected, read_sessions(exported))
+
+        archive.import_user_archive(db, exported, copy_user)
+        archive.export_user_archive(db, copy_user, copied)
+        mismatches += compare("다른 사용자로 복원 후 내보내기", expected, read_sessions(copied))
+
+    # 큰 본문은 blob으로 분리되고 같은 본문은 한 번만 저장되어야 함
+    large = {m['content'] for record in sessions for m in record['messages'] if len(m['content']) >= history.blob_min_size}
+    blobs = list(history._blob_ref(db, source_user, "-").parent.list_documents())
+    print(f"blob 문서: {len(blobs)}/{len(large)}개")
+    if len(blobs) != len(large):
+        mismatches.append('blobs')
+
+    if mismatches:
+        raise SystemExit(f"{len(mismatches)}개 항목이 원래 내용과 다릅니다: {sorted(set(mismatches))}")
@@ -1,29 +1,101 @@
 import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core import exceptions as google_exceptions
 from datetime import datetime
 from zoneinfo import ZoneInfo
+import hashlib
 import json
+import re
+import atexit
+import queue
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
 
 import chat
+import metrics
+import resources
 
-# Firebase 초기화
+# Firebase 초기화 (클라이언트는 resources에서 프로세스당 하나만 만들어 재사용)
 def initialize_firebase():
-    if not firebase_admin._apps:
-        cred_dict = dict(st.secrets["firebase"])
-        if "private_key" in cred_dict:
-            cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
-        cred = credentials.Certificate(cred_dict)
-        firebase_admin.initialize_app(cred)
-        
-    return firestore.client()
+    return resources.get_firestore_client()
+
+# 대화 내보내기: 한 줄에 메시지 하나인 NDJSON. 다운로드 버튼을 누를 때만 만들고(지연 생성),
+# 같은 대화(같은 messages 리스트, 같은 메시지 수)면 이전 결과를 재사용합니다.
+export_cache_size = 32
+_export_cache = OrderedDict()  # session_id -> (messages 리스트, 메시지 수, 파일 내용)
+_export_lock = threading.Lock()
+
+def conversation_to_ndjson(messages):
+    # _로 시작하는 키(렌더링 캐시 등)는 실행 중에만 쓰는 값이라 제외
+    return "".join(
+        json.dumps({k: v for k, v in m.items() if not k.startswith('_')}, ensure_ascii=False, separators=(',', ':')) + "\n"
+        for m in messages
+    )
 
 def save_conversation_as_json():
+    """(내보내기 함수, 파일 이름)을 반환합니다. 내보내기 함수는 st.download_button의 data로 넘기면 클릭할 때만 실행됩니다."""
     timestamp = datetime.now(ZoneInfo("Asia/Seoul")).strftime("%Y%m%d_%H%M%S")
-    filename = f"conversation_{timestamp}.json"
- 
-    json_data = json.dumps(st.session_state.messages, ensure_ascii=False, indent=2)
-    return json_data, filename
+    filename = f"conversation_{timestamp}.jsonl"
+
+    # 지연 생성 함수는 스크립트 밖에서 실행되므로 session_state 대신 지금의 리스트와 길이를 붙잡아 둠
+    session_id = st.session_state.session_id
+    messages = st.session_state.messages
+    count = len(messages)
+
+    def export():
+        with _export_lock:
+            cached = _export_cache.get(session_id)
+            if cached and cached[0] is messages and cached[1] == count:
+                return cached[2]
+        data = conversation_to_ndjson(messages[:count]).encode('utf-8')
+        with _export_lock:
+            _export_cache[session_id] = (messages, count, data)
+            _export_cache.move_to_end(session_id)
+            while len(_export_cache) > export_cache_size:
+                _export_cache.popitem(last=False)
+        return data
+    return export, filename
+
+def _valid_message(message):
+    return isinstance(message, dict) and message.get('role') in ('user', 'assistant') and isinstance(message.get('content'), str)
+
+def _imported_message(message):
+    # 파일에서 온 메시지는 role/content만 사용. num_tokens는 양의 정수일 때만 토큰 수 캐시로 유지 (아니면 다시 계산)
+    imported = {'role': message['role'], 'content': message['content']}
+    num_tokens = message.get('num_tokens')
+    if isinstance(num_tokens, int) and not isinstance(num_tokens, bool) and num_tokens > 0:
+        imported['num_tokens'] = num_tokens
+    return imported
+
+def load_conversation_from_lines(lines):
+    """
+    줄 단위로 읽으면서 대화를 불러옵니다. NDJSON(한 줄에 메시지 하나)은 한 줄씩 검사하고,
+    첫 글자가 [ 이면 이전 형식(JSON 배열)으로 읽습니다. (messages, 오류 메시지)를 반환합니다.
+    """
+    lines = iter(lines)
+    messages = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not messages and line.startswith('['):
+            legacy = load_conversation_from_json(line + "".join(lines))
+            if legacy is None or not all(_valid_message(message) for message in legacy):
+                return None, "올바른 JSON 형식이 아닙니다."
+            return [_imported_message(message) for message in legacy], None
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return None, f"{line_number}번째 줄이 올바른 JSON이 아닙니다."
+        if not _valid_message(message):
+            return None, f"{line_number}번째 줄에 role(user/assistant)과 content가 없습니다."
+        messages.append(_imported_message(message))
+    if not messages:
+        return None, "불러올 메시지가 없습니다."
+    return messages, None
 
 def load_conversation_from_json(json_text):
     try:
@@ -36,6 +108,323 @@ def load_conversation_from_json(json_text):
     except:
         return None
 
+# 제목(preview) 생성 큐: 저장/불러오기 경로에서 Claude 호출을 기다리지 않도록 백그라운드 스레드에서 생성
+_preview_known = set()    # preview가 있는 것으로 확인된 (user_email, session_id)
+_preview_pending = set()  # 큐에 들어가 있는 (user_email, session_id)
+_preview_queue = queue.Queue()
+_preview_lock = threading.Lock()
+_preview_thread = None
+
+def _preview_worker():
+    while True:
+        db, user_email, session_id, messages = _preview_queue.get()
+        key = (user_email, session_id)
+        try:
+            session_ref = _session_ref(db, user_email, session_id)
+            # 다른 프로세스나 이전 실행에서 이미 만든 제목이 있으면 다시 만들지 않음
+            existing_doc = session_ref.get(field_paths=['preview'])
+            if not existing_doc.exists or 'preview' not in existing_doc.to_dict():
+                preview = chat.get_preview_with_claude(messages)
+                session_ref.set({'preview': preview}, merge=True)
+                print(f"대화 제목 생성: {preview}")
+                update_session_index(user_email, session_id, preview=preview)
+                if user_email != 'anonymous':  # 검색은 로그인한 사용자만
+                    _terms_ref(db, user_email, session_id).set({'terms': firestore.ArrayUnion(sorted(search_terms(preview)))}, merge=True)
+                    index_session_terms(user_email, session_id, search_terms(preview), preview=preview)
+            with _preview_lock:
+                _preview_known.add(key)
+        except Exception as e:
+            print(f"대화 제목 생성 오류: {str(e)}")
+        finally:
+            with _preview_lock:
+                _preview_pending.discard(key)
+
+def request_preview(db, user_email, session_id, messages):
+    """제목이 없는 세션이면 제목 생성을 큐에 넣습니다. 이미 확인됐거나 대기 중이면 무시합니다."""
+    global _preview_thread
+    key = (user_email, session_id)
+    with _preview_lock:
+        if key in _preview_known or key in _preview_pending:
+            return
+        _preview_pending.add(key)
+        if _preview_thread is None or not _preview_thread.is_alive():
+            _preview_thread = threading.Thread(target=_preview_worker, daemon=True)
+            _preview_thread.start()
+    _preview_queue.put((db, user_email, session_id, list(messages)))
+
+def mark_preview_known(user_email, session_id):
+    with _preview_lock:
+        _preview_known.add((user_email, session_id))
+
+# 메시지 저장 구조: conversations/{user}/sessions/{session_id} 헤더 문서 + messages 하위 컬렉션(메시지당 문서 1개)
+# 턴마다 새로 추가되거나 편집된 메시지만 씁니다.
+_stored_counts = {}  # (user_email, session_id) -> Firestore에 저장된 메시지 문서 수
+_stored_terms = {}   # (user_email, session_id) -> Firestore에 마지막으로 기록한 검색 단어 목록
+max_batch_ops = 500  # Firestore 배치 쓰기 한도
+max_batch_bytes = 9 * 1024 * 1024  # 배치 하나에 담는 문서 크기 합 (Firestore 커밋 요청 한도 10MiB보다 여유 있게)
+
+def _doc_bytes(data):
+    """Firestore 문서 크기 추정: 필드 이름과 값의 크기 합 (문자열은 UTF-8 길이 + 1)"""
+    if isinstance(data, dict):
+        return sum(len(k.encode('utf-8')) + 1 + _doc_bytes(v) for k, v in data.items()) + 32
+    if isinstance(data, (list, tuple)):
+        return sum(_doc_bytes(v) for v in data)
+    if isinstance(data, str):
+        return len(data.encode('utf-8')) + 1
+    if isinstance(data, bytes):
+        return len(data)
+    return 8
+
+def _session_ref(db, user_email, session_id):
+    return db.collection('conversations') \
+             .document(user_email) \
+             .collection('sessions') \
+             .document(session_id)
+
+# 큰 메시지 본문은 내용 주소(sha256) 기반 blob으로 한 번만 저장: conversations/{user}/blobs/{sha256}
+# 메시지 문서에는 content 대신 content_ref만 남깁니다. 같은 파일을 여러 세션/편집에 붙여넣어도 blob은 하나.
+blob_min_size = 4096        # 이 길이(글자) 이상인 본문만 blob으로 저장
+blob_compress = True        # zlib 압축 (압축해서 더 작아질 때만 사용)
+blob_cache_size = 256       # 프로세스에서 기억하는 blob 수 (저장 여부 / 풀어둔 본문)
+_known_blobs = OrderedDict()  # (user_email, sha256) -> 본문 (Firestore에 있는 것으로 확인된 blob)
+_blob_lock = threading.Lock()
+blob_part_bytes = 900 * 1024  # blob 문서 하나에 넣는 최대 데이터 (Firestore 문서 한도 1MiB). 넘으면 parts 하위 컬렉션에 나눠 저장
+
+def _blob_ref(db, user_email, digest):
+    return db.collection('conversations').document(user_email).collection('blobs').document(digest)
+
+def _blob_doc(content):
+    data = content.encode('utf-8')
+    encoding = 'utf-8'
+    if blob_compress:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data, encoding = compressed, 'zlib'
+    return {'data': data, 'encoding': encoding, 'size': len(content)}
+
+def _blob_part_refs(blob_ref, blob):
+    return [blob_ref.collection('parts').document(f"{i:04d}") for i in range(blob.get('parts', 0))]
+
+def _blob_docs(db, user_email, digest, content):
+    """blob을 저장할 (참조, 문서) 목록. 문서 한도를 넘는 blob은 조각 문서들을 먼저, 조각 수를 적은 blob 문서를 마지막에 둡니다."""
+    ref = _blob_ref(db, user_email, digest)
+    blob = _blob_doc(content)
+    data = blob['data']
+    if len(data) <= blob_part_bytes:
+        return [(ref, blob)]
+    del blob['data']
+    blob['parts'] = (len(data) + blob_part_bytes - 1) // blob_part_bytes
+    parts = [data[i * blob_part_bytes:(i + 1) * blob_part_bytes] for i in range(blob['parts'])]
+    return [(part_ref, {'data': part}) for part_ref, part in zip(_blob_part_refs(ref, blob), parts)] + [(ref, blob)]
+
+def _blob_content(blob, parts=()):
+    """blob 문서(와 조각 문서 스냅샷)에서 본문을 복원합니다."""
+    if 'parts' in blob:
+        data = b"".join(part.to_dict()['data'] for part in sorted(parts, key=lambda part: part.id))
+    else:
+        data = blob['data']
+    if blob.get('encoding') == 'zlib':
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
+
+def _remember_blob(user_email, digest, content):
+    with _blob_lock:
+        _known_blobs[(user_email, digest)] = content
+        _known_blobs.move_to_end((user_email, digest))
+        while len(_known_blobs) > blob_cache_size:
+            _known_blobs.popitem(last=False)
+
+def _externalize_content(db, user_email, doc, blob_writes):
+    """큰 본문을 blob 참조로 바꾼 메시지 문서를 반환합니다. 새 blob은 blob_writes(digest -> ([(ref, 문서)], 본문))에 추가합니다."""
+    content = doc['content']
+    if len(content) < blob_min_size:
+        return doc
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    with _blob_lock:
+        known = (user_email, digest) in _known_blobs
+    if not known and digest not in blob_writes:
+        blob_writes[digest] = (_blob_docs(db, user_email, digest, content), content)
+    stored = {k: v for k, v in doc.items() if k != 'content'}
+    stored['content_ref'] = digest
+    return stored
+
+def _resolve_blobs(db, user_email, messages):
+    """content_ref로 저장된 메시지의 본문을 채웁니다. 캐시에 없는 blob은 get_all 한 번으로 읽습니다."""
+    refs = {m['content_ref'] for m in messages if 'content_ref' in m}
+    if not refs:
+        return messages
+    contents = {}
+    with _blob_lock:
+        for digest in refs:
+            if (user_email, digest) in _known_blobs:
+                contents[digest] = _known_blobs[(user_email, digest)]
+    missing = [_blob_ref(db, user_email, digest) for digest in refs if digest not in contents]
+    if missing:
+        with metrics.span('firestore_read_blobs'):
+            blobs = [blob for blob in db.get_all(missing) if blob.exists]
+            # 나눠 저장된 blob의 조각 (get_all은 순서를 보장하지 않으므로 _blob_content에서 정렬)
+            part_refs = [ref for blob in blobs for ref in _blob_part_refs(blob.reference, blob.to_dict())]
+            parts = {}
+            for part in (db.get_all(part_refs) if part_refs else ()):
+                parts.setdefault(part.reference.parent.parent.id, []).append(part)
+        for blob in blobs:
+            contents[blob.id] = _blob_content(blob.to_dict(), parts.get(blob.id, ()))
+            _remember_blob(user_email, blob.id, contents[blob.id])
+    for message in messages:
+        digest = message.pop('content_ref', None)
+        if digest is not None:
+            if digest not in contents:
+                print(f"메시지 본문을 찾을 수 없습니다: {digest}")
+            message['content'] = contents.get(digest, "")
+    return messages
+
+def _message_doc(index, message):
+    """저장할 메시지 필드만 골라냅니다 (토큰 수 캐시 포함)."""
+    return {
+        'index': index,
+        'role': message['role'],
+        'content': message['content'],
+        'num_tokens': chat.message_tokens(message),
+    }
+
+def _saved_upto(user_email, session_id):
+    """현재 세션에서 앞에서부터 변경 없이 저장된 메시지 수"""
+    saved = st.session_state.get('saved_upto')
+    if saved and saved[0] == (user_email, session_id):
+        return saved[1]
+    return 0
+
+def mark_unsaved(index):
+    """index 이후 메시지가 바뀌었음을 표시합니다 (메시지 편집 시)."""
+    saved = st.session_state.get('saved_upto')
+    if saved and saved[1] > index:
+        st.session_state.saved_upto = (saved[0], index)
+
+# 저장 버퍼(write-behind): 저장 요청은 세션별로 합쳐서 보관하고 백그라운드 스레드가 모아서 씁니다.
+save_flush_delay = 0.5   # 첫 저장 요청 후 기록까지 최대 대기 시간 (초)
+save_retry_delay = 5.0   # 기록 실패 시 재시도 간격 (초)
+save_max_attempts = 5    # 일시적 오류의 최대 시도 횟수. 넘거나 영구적인 오류면 그 요청은 버리고 다음 저장에서 전체를 다시 씀
+_failed_saves = {}       # (user_email, session_id) -> 버린 저장의 오류 메시지
+_pending_saves = {}      # (user_email, session_id) -> {'db', 'writes': {index: doc}, 'terms', 'count', 'header'}
+_save_cond = threading.Condition()
+_flush_lock = threading.RLock()  # 같은 세션을 두 스레드가 동시에 쓰지 않도록 기록을 직렬화
+_save_thread = None
+
+def _merge_pending(older, newer):
+    """같은 세션의 저장 요청 두 개를 합칩니다. 새 요청의 메시지 수와 헤더가 우선합니다."""
+    writes = dict(older['writes'])
+    writes.update(newer['writes'])
+    merged = dict(newer)
+    merged['writes'] = {i: doc for i, doc in writes.items() if i < newer['count']}
+    merged['terms'] = newer['terms'] if newer['terms'] is not None else older['terms']
+    merged['attempts'] = older.get('attempts', 0)
+    return merged
+
+def _write_pending(key, pending):
+    with metrics.span('firestore_write'):
+        _write_pending_batches(key, pending)
+
+def _write_pending_batches(key, pending):
+    db = pending['db']
+    session_ref = _session_ref(db, *key)
+    messages_ref = session_ref.collection('messages')
+    stored_count = _stored_counts.get(key, 0)
+
+    # 큰 본문은 blob으로 분리 (이미 저장된 blob은 다시 쓰지 않음)
+    blob_writes = {}
+    docs = {i: _externalize_content(db, key[0], doc, blob_writes) for i, doc in pending['writes'].items()}
+
+    # 새 blob을 먼저 쓰고(참조가 항상 존재하도록), 바뀐 메시지만 쓰고, 편집으로 잘려나간 메시지는 삭제한 뒤 헤더 갱신
+    writes = [('blob', write) for blob_docs, _ in blob_writes.values() for write in blob_docs] + \
+             [('set', i) for i in sorted(docs)] + \
+             [('delete', i) for i in range(pending['count'], stored_count)]
+    # 배치는 작업 수(max_batch_ops)와 문서 크기 합(max_batch_bytes) 중 먼저 닿는 한도에서 나눠 커밋
+    batch = db.batch()
+    ops = 0
+    size = 0
+    for op, i in writes:
+        if op == 'blob':
+            ref, data = i
+        elif op == 'set':
+            ref, data = messages_ref.document(f"{i:06d}"), docs[i]
+        else:
+            ref, data = messages_ref.document(f"{i:06d}"), None
+        data_bytes = 0 if data is None else _doc_bytes(data)
+        if ops and (ops == max_batch_ops - 2 or size + data_bytes > max_batch_bytes):
+            batch.commit()
+            batch = db.batch()
+            ops = 0
+            size = 0
+        if data is None:
+            batch.delete(ref)
+        else:
+            batch.set(ref, data)
+        ops += 1
+        size += data_bytes
+    # 마지막 배치에 검색 단어와 헤더 (두 작업 자리는 위에서 남겨둠)
+    terms_doc = None if pending['terms'] is None else {'terms': pending['terms']}
+    if ops and size + _doc_bytes(terms_doc or {}) + _doc_bytes(pending['header']) > max_batch_bytes:
+        batch.commit()
+        batch = db.batch()
+    if terms_doc is not None:
+        batch.set(_terms_ref(db, *key), terms_doc, merge=True)
+    batch.set(session_ref, pending['header'], merge=True)
+    batch.commit()
+    _stored_counts[key] = pending['count']
+    if pending['terms'] is not None:
+        _stored_terms[key] = pending['terms']
+    for digest, (_, content) in blob_writes.items():
+        _remember_blob(key[0], digest, content)
+
+def flush_saves(key=None):
+    """대기 중인 저장을 지금 기록합니다. key를 주면 그 세션만 기록합니다."""
+    with _flush_lock:
+        with _save_cond:
+            keys = [key] if key is not None else list(_pending_saves)
+            items = [(k, _pending_saves.pop(k)) for k in keys if k in _pending_saves]
+        failed = False
+        for k, pending in items:
+            try:
+                _write_pending(k, pending)
+                print(f"db에 {pending['header']['user_name']} 의 대화를 저장했습니다. (메시지 {len(pending['writes'])}개)")
+            except Exception as e:
+                attempts = pending.get('attempts', 0) + 1
+                if not _is_transient(e) or attempts >= save_max_attempts:
+                    # 다시 시도해도 같은 결과인 오류: 버리고, 다음 저장 요청에서 메시지 전체를 다시 씀
+                    print(f"대화 저장 실패 ({attempts}회 시도, 포기): {str(e)}")
+                    with _save_cond:
+                        _failed_saves[k] = str(e)
+                    continue
+                print(f"대화 저장 오류 ({attempts}회 시도): {str(e)}")
+                failed = True
+                pending['attempts'] = attempts
+                # 실패한 요청은 이후 요청과 합쳐서 다시 시도
+                with _save_cond:
+                    if k in _pending_saves:
+                        _pending_saves[k] = _merge_pending(pending, _pending_saves[k])
+                    else:
+                        _pending_saves[k] = pending
+        return not failed
+
+def _is_transient(e):
+    # 네트워크/서버 쪽 일시적 오류만 재시도 (INVALID_ARGUMENT, 권한 오류 등은 재시도해도 실패)
+    return isinstance(e, (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                          google_exceptions.InternalServerError, google_exceptions.TooManyRequests,
+                          google_exceptions.ResourceExhausted, google_exceptions.Aborted,
+                          google_exceptions.Unknown, google_exceptions.RetryError,
+                          ConnectionError, TimeoutError))
+
+def _save_worker():
+    while True:
+        with _save_cond:
+            while not _pending_saves:
+                _save_cond.wait()
+        time.sleep(save_flush_delay)  # 그 사이에 들어오는 저장 요청은 합쳐짐
+        if not flush_saves():
+            time.sleep(save_retry_delay)
+
+atexit.register(flush_saves)
+
 # 대화 저장 함수 (수정)
 def save_conversation_to_db(db):
     if not st.session_state.messages:
@@ -47,37 +436,56 @@ def save_conversation_to_db(db):
         user_email = st.session_state.user_email
         user_name = st.session_state.user_name
     
-    try:
-        session_ref = db.collection('conversations') \
-                        .document(user_email) \
-                        .collection('sessions') \
-                        .document(st.session_state.session_id)
+    global _save_thread
+    session_id = st.session_state.session_id
+    messages = st.session_state.messages
+    key = (user_email, session_id)
+    saved_upto = min(_saved_upto(user_email, session_id), len(messages))
+    with _save_cond:
+        failed = _failed_saves.pop(key, None)
+    if failed is not None:  # 이전 저장을 버렸으므로 이미 저장된 것으로 표시한 메시지도 다시 씀
+        print(f"이전 저장 실패({failed})로 대화 전체를 다시 저장합니다.")
+        saved_upto = 0
 
-        data = {
-            'messages': st.session_state.messages,
+    writes = {i: _message_doc(i, messages[i]) for i in range(saved_upto, len(messages))}
+    # 검색은 로그인한 사용자만 하므로 anonymous 세션은 검색 단어를 만들거나 기록하지 않음
+    terms = None if user_email == 'anonymous' else session_search_terms(messages, _known_preview(user_email, session_id))
+    pending = {
+        'db': db,
+        'writes': writes,
+        'terms': None if terms == _stored_terms.get(key) else terms,  # 세션 전체의 검색 단어 (바뀐 경우에만 기록)
+        'count': len(messages),
+        'header': {
+            'messages': firestore.DELETE_FIELD,  # 이전 형식(문서 안 배열)에서 옮겨온 경우 제거
+            'message_count': len(messages),
             'updated_at': firestore.SERVER_TIMESTAMP,
-            'session_id': st.session_state.session_id,
+            'session_id': session_id,
             'user_email': user_email,
-            'user_name': user_name
-        }
-        print(f"db에 {user_name} 의 대화를 저장합니다.")
-
-        # preview 조건: user 메시지가 2개 이상 & preview가 없을 때 & 로그인한 사용자에 한해서만
-        user_messages = [m for m in st.session_state.messages if m.get("role") == "user"]
-        if (len(user_messages) >= 2) and ('user_email' in st.session_state): 
-            existing_doc = session_ref.get()
-            if not existing_doc.exists or 'preview' not in existing_doc.to_dict():
-                preview = chat.get_preview_with_claude(st.session_state.messages)
-                data['preview'] = preview
+            'user_name': user_name,
+            'summary': st.session_state.get('summary')
+        },
+    }
+    with _save_cond:
+        if key in _pending_saves:
+            pending = _merge_pending(_pending_saves[key], pending)
+        _pending_saves[key] = pending
+        if _save_thread is None or not _save_thread.is_alive():
+            _save_thread = threading.Thread(target=_save_worker, daemon=True)
+            _save_thread.start()
+        _save_cond.notify()
+    st.session_state.saved_upto = (key, len(messages))
+    update_session_index(user_email, session_id)
+    if terms is not None:
+        index_session_terms(user_email, session_id, terms)
 
-        session_ref.set(data, merge=True)
-        return True
-    except Exception as e:
-        print(f"대화 저장 오류: {str(e)}")
-        return False
+    # preview 조건: user 메시지가 2개 이상 & preview가 없을 때 & 로그인한 사용자에 한해서만 (백그라운드 생성)
+    user_messages = [m for m in messages if m.get("role") == "user"]
+    if (len(user_messages) >= 2) and ('user_email' in st.session_state): 
+        request_preview(db, user_email, session_id, messages)
+    return True
 
 def load_conversation_from_db(session_id, db):
-    if 'user_email' not in st.session_state: 
+    if not st.session_state.user_email: 
         user_email = 'anonymous'
         user_name = 'anonymous'
     else:
@@ -86,22 +494,42 @@ def load_conversation_from_db(session_id, db):
     print(f"db에서 {user_name} 의 대화를 로드합니다.")
 
     try:
-        doc_ref = db.collection('conversations') \
-                    .document(user_email) \
-                    .collection('sessions') \
-                    .document(session_id)
+        flush_saves((user_email, session_id))  # 이 세션의 대기 중인 저장을 먼저 기록 (방금 저장한 내용도 읽을 수 있도록)
+        read_started = time.perf_counter()
+        doc_ref = _session_ref(db, user_email, session_id)
         doc = doc_ref.get()
 
         if doc.exists:
             data = doc.to_dict()
+            key = (user_email, session_id)
+            if 'messages' in data:
+                # 이전 형식: 다음 저장 때 전체를 하위 컬렉션으로 옮김
+                messages = data['messages']
+                _stored_counts[key] = 0
+                st.session_state.saved_upto = (key, 0)
+            else:
+                # 하위 컬렉션을 한 번의 쿼리로 순서대로 읽음 (message_count 이후는 삭제 실패로 남은 문서)
+                message_count = data.get('message_count', 0)
+                messages = []
+                for message_doc in doc_ref.collection('messages').order_by('index').stream():
+                    message = message_doc.to_dict()
+                    if message['index'] >= message_count:
+                        break
+                    messages.append({k: v for k, v in message.items() if k != 'index' and v is not None})
+                _resolve_blobs(db, user_email, messages)
+                _stored_counts[key] = max(message_count, len(messages))
+                st.session_state.saved_upto = (key, len(messages))
+            metrics.record('firestore_read_session', time.perf_counter() - read_started)
+
             st.session_state.session_id = session_id
-            messages = data.get('messages', [])
+            st.session_state.summary = data.get('summary')
             st.query_params['session_id'] = session_id
 
-            # preview가 없고 메시지가 2개 이상이고 로그인한 사용자에 한해서 생성
-            if 'preview' not in data and len(messages) >= 2 and 'user_email' in st.session_state:
-                preview = chat.get_preview_with_claude(messages)
-                doc_ref.update({'preview': preview})
+            # preview가 없고 메시지가 2개 이상이고 로그인한 사용자에 한해서 생성 (백그라운드)
+            if 'preview' in data:
+                mark_preview_known(user_email, session_id)
+            elif len(messages) >= 2 and 'user_email' in st.session_state:
+                request_preview(db, user_email, session_id, messages)
                 
             return messages
         else:
@@ -111,17 +539,53 @@ def load_conversation_from_db(session_id, db):
         st.error(f"대화 불러오기 오류: {str(e)}")
         return []
 
+# 사이드바 세션 목록 캐시: 사용자별로 preview/updated_at만 가져와(projection) TTL 동안 재사용하고,
+# 이 클라이언트에서 저장하면 캐시를 직접 갱신합니다.
+session_index_ttl = 300  # 초
+_session_index = {}      # user_email -> {'fetched_at', 'limit', 'sessions': 최신순 목록}
+_session_index_lock = threading.Lock()
+
+def _preview_text(preview):
+    return (preview or "New Chat").strip().split('\n')[0]
+
+def update_session_index(user_email, session_id, preview=None):
+    """캐시된 세션 목록을 갱신합니다. preview가 없으면 방금 저장된 세션으로 보고 맨 앞으로 옮깁니다."""
+    with _session_index_lock:
+        index = _session_index.get(user_email)
+        if index is None:
+            return
+        sessions = index['sessions']
+        entry = next((s for s in sessions if s['session_id'] == session_id), None)
+        if preview is not None:
+            if entry is not None:
+                entry['preview'] = _preview_text(preview)
+            return
+        if entry is not None:
+            sessions.remove(entry)
+        else:
+            entry = {'session_id': session_id, 'preview': _preview_text(None)}
+        entry['updated_at'] = datetime.now(timezone.utc)
+        sessions.insert(0, entry)
+
 def get_recent_sessions(db, limit=30):
-    """최근 세션 목록을 가져오는 함수"""
+    """최근 세션 목록을 가져오는 함수 (캐시가 유효하면 Firestore를 읽지 않음)"""
     if not st.session_state.user_email:
         return []
+    user_email = st.session_state.user_email
+
+    with _session_index_lock:
+        index = _session_index.get(user_email)
+        if index and index['limit'] >= limit and time.time() - index['fetched_at'] < session_index_ttl:
+            return list(index['sessions'][:limit])
     
     try:
         sessions_ref = db.collection('conversations') \
-                         .document(st.session_state.user_email) \
+                         .document(user_email) \
                          .collection('sessions')
-        query = sessions_ref.order_by('updated_at', direction=firestore.Query.DESCENDING).limit(limit)
-        sessions = list(query.stream())
+        query = sessions_ref.select(['preview', 'updated_at']) \
+                            .order_by('updated_at', direction=firestore.Query.DESCENDING).limit(limit)
+        with metrics.span('firestore_read_sessions'):
+            sessions = list(query.stream())
         
         result = []
         for session in sessions:
@@ -129,20 +593,193 @@ def get_recent_sessions(db, limit=30):
             data = session.to_dict()
             
             # preview 결정
-            preview = data.get('preview', "New Chat").strip().split('\n')[0]
+            if 'preview' in data:
+                mark_preview_known(user_email, session_id)
+            preview = _preview_text(data.get('preview'))
             
             result.append({
                 'session_id': session_id,
                 'preview': preview,
                 'updated_at': data.get('updated_at')
             })
-        
-        return result
+            index_session_terms(user_email, session_id, search_terms(preview), preview=preview, updated_at=data.get('updated_at'))
+
+        with _session_index_lock:
+            _session_index[user_email] = {'fetched_at': time.time(), 'limit': limit, 'sessions': result}
+        return list(result)
         
     except Exception as e:
         st.error(f"세션 로딩 중 오류 발생: {str(e)}")
         return []        
 
+def get_sessions_page(db, start_after=None, page_size=30):
+    """updated_at 기준 커서(start_after) 다음의 세션 목록 한 페이지와 다음 커서를 가져옵니다. 마지막 페이지면 다음 커서는 None."""
+    if not st.session_state.user_email:
+        return [], None
+    user_email = st.session_state.user_email
+
+    try:
+        sessions_ref = db.collection('conversations') \
+                         .document(user_email) \
+                         .collection('sessions')
+        query = sessions_ref.select(['preview', 'updated_at']) \
+                            .order_by('updated_at', direction=firestore.Query.DESCENDING)
+        if start_after is not None:
+            query = query.start_after({'updated_at': start_after})
+        result = []
+        with metrics.span('firestore_read_sessions'):
+            sessions = list(query.limit(page_size).stream())
+        for session in sessions:
+            data = session.to_dict()
+            if 'preview' in data:
+                mark_preview_known(user_email, session.id)
+            preview = _preview_text(data.get('preview'))
+            result.append({'session_id': session.id, 'preview': preview, 'updated_at': data.get('updated_at')})
+            index_session_terms(user_email, session.id, search_terms(preview), preview=preview, updated_at=data.get('updated_at'))
+
+        next_cursor = result[-1]['updated_at'] if len(result) == page_size else None
+        return result, next_cursor
+    except Exception as e:
+        st.error(f"세션 로딩 중 오류 발생: {str(e)}")
+        return [], None
+
+# 대화 검색: 세션마다 메시지/제목의 단어를 별도 문서(conversations/{email}/search_terms/{session_id}의 terms 배열,
+# Firestore가 색인)와 프로세스 내 역색인(postings)에 저장합니다. 세션 헤더는 목록 조회용으로 작게 유지합니다.
+# 한글은 조사가 붙어도 찾을 수 있도록 2글자 단위로 색인합니다.
+search_terms_max = 2000   # 세션 하나에 색인하는 최대 단어 수 (자주 나온 단어 우선, 1MB 문서 한도보다 충분히 작게)
+search_max_query_terms = 6
+search_cache_size = 100   # 검색 결과 캐시 (검색창이 그대로인 재실행에서는 Firestore를 조회하지 않음)
+search_cache_ttl = 60     # 초. 다른 프로세스에서 저장한 대화는 이 시간이 지나야 검색 결과에 반영
+_term_pattern = re.compile(r'[0-9a-z_]{2,}|[가-힣]{2,}')
+_search_postings = {}  # user_email -> {term: set(session_id)}
+_search_sessions = {}  # user_email -> {session_id: {'session_id', 'preview', 'updated_at'}}
+_search_versions = {}  # user_email -> 이 프로세스에서 역색인이 바뀐 횟수 (검색 결과 캐시 무효화용)
+_search_cache = OrderedDict()  # (user_email, 검색 단어) -> (조회 시각, 버전, 결과)
+_search_lock = threading.Lock()
+
+def _term_counts(text):
+    counts = Counter()
+    for word in _term_pattern.findall(text.lower()):
+        if '가' <= word[0] <= '힣':
+            counts.update(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            counts[word[:40]] += 1
+    return counts
+
+def search_terms(text):
+    return set(_term_counts(text))
+
+def _message_term_counts(message):
+    # 내용이 바뀌지 않은 메시지는 다시 세지 않도록 메시지에 보관 (_로 시작하는 키는 저장/내보내기에서 제외)
+    cached = message.get('_terms')
+    if cached is None or cached[0] is not message['content']:
+        cached = (message['content'], _term_counts(message['content']))
+        message['_terms'] = cached
+    return cached[1]
+
+def session_search_terms(messages, preview=None):
+    """세션 전체에서 색인할 단어 목록. search_terms_max개를 넘으면 자주 나온 단어(동률이면 먼저 나온 단어)를 남깁니다."""
+    counts = Counter()
+    for message in messages:
+        counts.update(_message_term_counts(message))
+    if preview:
+        counts.update(_term_counts(preview))
+    return [term for term, _ in counts.most_common(search_terms_max)]
+
+def _terms_ref(db, user_email, session_id):
+    return db.collection('conversations').document(user_email).collection('search_terms').document(session_id)
+
+def _known_preview(user_email, session_id):
+    with _search_lock:
+        info = _search_sessions.get(user_email, {}).get(session_id)
+    if info is None or info['preview'] == _preview_text(None):
+        return None
+    return info['preview']
+
+def index_session_terms(user_email, session_id, terms, preview=None, updated_at=None):
+    """프로세스 내 역색인에 세션의 단어를 추가하고 세션 정보를 갱신합니다."""
+    with _search_lock:
+        postings = _search_postings.setdefault(user_email, {})
+        changed = False
+        for term in terms:
+            ids = postings.setdefault(term, set())
+            if session_id not in ids:
+                ids.add(session_id)
+                changed = True
+        if changed:
+            _search_versions[user_email] = _search_versions.get(user_email, 0) + 1
+        info = _search_sessions.setdefault(user_email, {}).setdefault(
+            session_id, {'session_id': session_id, 'preview': _preview_text(None), 'updated_at': None})
+        if preview is not None:
+            info['preview'] = _preview_text(preview)
+        info['updated_at'] = updated_at or info['updated_at'] or datetime.now(timezone.utc)
+
+def search_sessions(db, query_text, limit=30):
+    """검색어의 모든 단어를 포함하는 세션을 최신순으로 찾습니다. 문서를 훑지 않고 단어 색인만 조회합니다."""
+    if not st.session_state.user_email:
+        return []
+    user_email = st.session_state.user_email
+    terms = tuple(sorted(search_terms(query_text), key=len, reverse=True)[:search_max_query_terms])
+    if not terms:
+        return []
+
+    # 같은 검색어로 다시 실행되면 캐시된 결과 사용 (이 프로세스에서 저장해 색인이 바뀌면 다시 조회)
+    cache_key = (user_email, terms)
+    with _search_lock:
+        version = _search_versions.get(user_email, 0)
+        cached = _search_cache.get(cache_key)
+        if cached is not None and cached[1] == version and time.time() - cached[0] < search_cache_ttl:
+            _search_cache.move_to_end(cache_key)
+            return [dict(s) for s in cached[2][:limit]]
+
+    try:
+        user_ref = db.collection('conversations').document(user_email)
+        terms_ref = user_ref.collection('search_terms')
+        matched_ids = set()
+        for i, term in enumerate(terms):
+            # 아직 기록되지 않은 저장(write-behind)도 프로세스 내 역색인으로 찾음
+            with _search_lock:
+                ids = set(_search_postings.get(user_email, {}).get(term, ()))
+            # 문서 ID만 필요하므로 단어 배열은 받지 않음 (빈 projection은 모든 필드를 반환)
+            query = terms_ref.where(filter=FieldFilter('terms', 'array_contains', term)).select(['__name__'])
+            with metrics.span('firestore_search'):
+                ids.update(doc.id for doc in query.stream())
+            matched_ids = ids if i == 0 else matched_ids & ids
+            if not matched_ids:
+                break
+
+        # 이 프로세스가 제목/시각을 모르는 세션만 헤더에서 읽음
+        with _search_lock:
+            known = _search_sessions.get(user_email, {})
+            missing = [session_id for session_id in matched_ids if session_id not in known]
+        if missing:
+            sessions_ref = user_ref.collection('sessions')
+            with metrics.span('firestore_search'):
+                headers = list(db.get_all([sessions_ref.document(session_id) for session_id in missing],
+                                          field_paths=['preview', 'updated_at']))
+            for header in headers:
+                if header.exists:
+                    data = header.to_dict()
+                    index_session_terms(user_email, header.id, (), preview=data.get('preview'), updated_at=data.get('updated_at'))
+
+        with _search_lock:
+            known = _search_sessions.get(user_email, {})
+            result = [dict(known[session_id]) for session_id in matched_ids if session_id in known]
+        result.sort(key=lambda s: _sort_timestamp(s['updated_at']), reverse=True)
+        with _search_lock:
+            _search_cache[cache_key] = (time.time(), version, result)
+            while len(_search_cache) > search_cache_size:
+                _search_cache.popitem(last=False)
+        return [dict(s) for s in result[:limit]]
+    except Exception as e:
+        st.error(f"대화 검색 중 오류 발생: {str(e)}")
+        return []
+
+def _sort_timestamp(timestamp):
+    if hasattr(timestamp, 'timestamp'):
+        return timestamp.timestamp()
+    return 0
+
 from datetime import timezone, timedelta
 
 def group_sessions_by_time(recent_sessions):
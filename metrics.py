@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 구간별 소요 시간과 턴별 토큰 사용량 수집
+# - span("이름"): 블록 실행 시간을 히스토그램에 누적 (스크립트 실행 중이면 그 실행의 기록에도 더함)
+# - record_turn(...): 응답 한 번의 토큰/지연 시간
+# 내보내기: METRICS_FILE(한 줄에 기록 하나인 NDJSON)과 METRICS_PORT(Prometheus 텍스트 형식 /metrics)
+metrics_file = os.environ.get('METRICS_FILE')
+metrics_port = int(os.environ.get('METRICS_PORT', 0))
+metric_prefix = "claude_app"
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_spans = {}        # 이름 -> {'count', 'sum', 'max', 'buckets': [구간별 개수]}
+_tokens = {}       # (model, 종류) -> 누적 토큰 수
+_turns = {}        # (model, 캐시 적중 여부) -> 턴 수
+_lock = threading.Lock()
+_file_lock = threading.Lock()
+_run = threading.local()  # 현재 스크립트 실행에서 기록된 구간
+_server = None
+
+def record(name, seconds):
+    with _lock:
+        stat = _spans.get(name)
+        if stat is None:
+            stat = _spans[name] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(latency_buckets)}
+        stat['count'] += 1
+        stat['sum'] += seconds
+        stat['max'] = max(stat['max'], seconds)
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                stat['buckets'][i] += 1
+                break
+    spans = getattr(_run, 'spans', None)
+    if spans is not None:
+        spans[name] = spans.get(name, 0.0) + seconds
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+def begin_run():
+    """스크립트 실행 시작. 이후 같은 스레드에서 기록한 구간은 이 실행의 기록에 모입니다."""
+    _run.started = time.perf_counter()
+    _run.spans = {}
+
+def end_run():
+    """스크립트 실행 끝. 전체 실행 시간을 기록하고 실행별 기록을 파일로 내보냅니다."""
+    started = getattr(_run, 'started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    spans = _run.spans
+    _run.started = _run.spans = None
+    record('script_run', seconds)
+    _write({'type': 'run', 'seconds': round(seconds, 4), 'spans': {k: round(v, 4) for k, v in spans.items()}})
+
+def record_turn(model, input_tokens=0, output_tokens=0, cache_read_tokens=0, cache_creation_tokens=0,
+                ttft=None, stream_seconds=None, cached=False):
+    with _lock:
+        for kind, count in (('input', input_tokens), ('output', output_tokens),
+                            ('cache_read', cache_read_tokens), ('cache_creation', cache_creation_tokens)):
+            _tokens[(model, kind)] = _tokens.get((model, kind), 0) + (count or 0)
+        _turns[(model, cached)] = _turns.get((model, cached), 0) + 1
+    _write({'type': 'turn', 'model': model, 'cached': cached,
+            'input_tokens': input_tokens, 'output_tokens': output_tokens,
+            'cache_read_tokens': cache_read_tokens, 'cache_creation_tokens': cache_creation_tokens,
+            'ttft': None if ttft is None else round(ttft, 4),
+            'stream_seconds': None if stream_seconds is None else round(stream_seconds, 4)})
+
+def _write(entry):
+    if not metrics_file:
+        return
+    entry['time'] = time.time()
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    try:
+        with _file_lock, open(metrics_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+    except OSError as e:
+        print(f"메트릭 기록 실패: {e}")
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+def prometheus_text():
+    """지금까지의 기록을 Prometheus 텍스트 형식으로 반환합니다."""
+    lines = [f"# TYPE {metric_prefix}_span_seconds histogram"]
+    with _lock:
+        for name, stat in sorted(_spans.items()):
+            cumulative = 0
+            for bound, count in zip(latency_buckets, stat['buckets']):
+                cumulative += count
+                lines.append(f'{metric_prefix}_span_seconds_bucket{{span="{_label(name)}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric_prefix}_span_seconds_bucket{{span="{_label(name)}",le="+Inf"}} {stat["count"]}')
+            lines.append(f'{metric_prefix}_span_seconds_sum{{span="{_label(name)}"}} {stat["sum"]:.6f}')
+            lines.append(f'{metric_prefix}_span_seconds_count{{span="{_label(name)}"}} {stat["count"]}')
+        lines.append(f"# TYPE {metric_prefix}_span_seconds_max gauge")
+        for name, stat in sorted(_spans.items()):
+            lines.append(f'{metric_prefix}_span_seconds_max{{span="{_label(name)}"}} {stat["max"]:.6f}')
+        lines.append(f"# TYPE {metric_prefix}_tokens_total counter")
+        for (model, kind), count in sorted(_tokens.items()):
+            lines.append(f'{metric_prefix}_tokens_total{{model="{_label(model)}",kind="{kind}"}} {count}')
+        lines.append(f"# TYPE {metric_prefix}_turns_total counter")
+        for (model, cached), count in sorted(_turns.items()):
+            lines.append(f'{metric_prefix}_turns_total{{model="{_label(model)}",cached="{str(cached).lower()}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # 요청마다 로그를 남기지 않음
+        pass
+
+def start_server():
+    """METRICS_PORT가 설정되어 있으면 /metrics 엔드포인트를 프로세스당 한 번 띄웁니다."""
+    global _server
+    if not metrics_port:
+        return
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer(('0.0.0.0', metrics_port), _MetricsHandler)
+        except OSError as e:
+            print(f"메트릭 서버 시작 실패: {e}")
+            _server = False  # 다시 시도하지 않음
+            return
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    print(f"메트릭 엔드포인트: http://0.0.0.0:{metrics_port}/metrics")
@@ -0,0 +1,77 @@
+import streamlit as st
+import anthropic
+from anthropic import Anthropic
+import firebase_admin
+from firebase_admin import credentials, firestore
+import httpx
+import threading
+import time
+
+# 프로세스 전체에서 하나씩만 만드는 외부 클라이언트 (st.cache_resource: 재실행/세션 사이에 재사용)
+
+# Anthropic HTTP 연결 풀: 스트리밍 응답, 요약, 미리보기, 토큰 계산이 동시에 연결을 사용
+anthropic_max_connections = 50
+anthropic_max_keepalive = 20
+anthropic_keepalive_expiry = 120  # 초. 기본값(5초)이면 답변을 읽는 사이에 연결이 끊겨 TLS 연결을 다시 맺음
+anthropic_timeout = httpx.Timeout(600.0, connect=10.0)
+
+health_check_timeout = 5.0  # 초
+
+@st.cache_resource
+def get_anthropic_client():
+    http_client = anthropic.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=anthropic_max_connections,
+            max_keepalive_connections=anthropic_max_keepalive,
+            keepalive_expiry=anthropic_keepalive_expiry,
+        ),
+        timeout=anthropic_timeout,
+    )
+    client = Anthropic(api_key=st.secrets['ANTHROPIC_API_KEY'], http_client=http_client)
+    _warm_up("Anthropic", lambda: client.models.list(limit=1))
+    return client
+
+@st.cache_resource
+def get_firestore_client():
+    if not firebase_admin._apps:
+        cred_dict = dict(st.secrets["firebase"])
+        if "private_key" in cred_dict:
+            cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
+        cred = credentials.Certificate(cred_dict)
+        firebase_admin.initialize_app(cred)
+
+    db = firestore.client()
+    _warm_up("Firestore", lambda: _ping_firestore(db))
+    return db
+
+def _ping_firestore(db, timeout=None):
+    # 존재하지 않는 문서 하나를 읽어 인증 토큰 발급과 gRPC 채널 연결까지 끝내둠
+    return db.collection('health').document('ping').get(timeout=timeout)
+
+def _warm_up(name, ping):
+    # 첫 요청의 연결 비용(TLS, 인증)을 백그라운드에서 미리 치름. 실패해도 실제 요청에서 다시 연결함
+    def run():
+        start = time.monotonic()
+        try:
+            ping()
+            print(f"{name} 연결 준비 완료 ({(time.monotonic() - start) * 1000:.0f}ms)")
+        except Exception as e:
+            print(f"{name} 연결 준비 실패: {e}")
+    threading.Thread(target=run, daemon=True).start()
+
+def health_check():
+    """Firestore와 Anthropic API에 실제로 요청을 보내 상태와 응답 시간을 확인합니다."""
+    checks = {
+        'firestore': lambda: _ping_firestore(get_firestore_client(), timeout=health_check_timeout),
+        'anthropic': lambda: get_anthropic_client().with_options(timeout=health_check_timeout, max_retries=0).models.list(limit=1),
+    }
+    result = {}
+    for name, ping in checks.items():
+        start = time.monotonic()
+        try:
+            ping()
+            result[name] = {'ok': True, 'latency_ms': round((time.monotonic() - start) * 1000)}
+        except Exception as e:
+            result[name] = {'ok': False, 'latency_ms': round((time.monotonic() - start) * 1000), 'error': str(e)}
+    result['ok'] = all(check['ok'] for check in result.values())
+    return result
@@ -184,6 +184,14 @@ def style_navigation():
     .nav-button:link {
         color: #444 !important;  /* 링크 기본 색상도 설정 */
     }
+    .hidden-turn {
+        scroll-margin-top: 70px;
+        font-size: 0.85rem;
+        color: #888;
+        white-space: nowrap;
+        overflow: hidden;
+        text-overflow: ellipsis;
+    }
     </style>
     """, unsafe_allow_html=True)
     
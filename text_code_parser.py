@@ -1,127 +1,336 @@
 import re
+from functools import lru_cache
+
+import metrics
+
+
+# 문자열 리터럴: 삼중 따옴표(여러 줄) / 이중 / 단일 따옴표를 한 번의 스캔으로 찾음
+_STRING_LITERAL = re.compile(
+    r'(?s:""".*?""")'
+    r"|(?s:'''.*?''')"
+    r'|"(?:[^"\\]|\\.)*"'
+    r"|'(?:[^'\\]|\\.)*'"
+)
+
+# 그 줄만으로 코드라고 판단하는 줄 패턴 (strip된 줄의 맨 앞에서 한 번만 매칭)
+_CODE_LINE = re.compile(
+    r"[\(\)\[\]\{\}\s,]*[\(\)\[\]\{\}][\(\)\[\]\{\}\s,]*$"  # 괄호로만 이루어진 줄
+    r"|(?:for|if|elif|else|while|def|class|try|except|finally|with|async\s+def|await|match|case|return|yield|raise|break|continue|pass|import|from|global|nonlocal|assert)\b"
+    r"|[#@]"                                                 # 주석, 데코레이터
+    r"|[a-zA-Z_][a-zA-Z0-9_\.]*\s*\([^)]*\)\s*$"             # 함수 호출
+    r"|[a-zA-Z_][a-zA-Z0-9_,\s]*\s*=\s*.+"                   # 변수 할당
+)
+
+# 언어별 줄 규칙 (strip된 줄의 맨 앞에서 매칭). 블록마다 일치한 줄 수가 가장 많은 언어를 펜스 언어로 사용하고,
+# 동점이면 먼저 등록된 언어, 어느 언어와도 일치하지 않은 코드 블록은 python으로 표시합니다.
+# 위의 일반 규칙으로는 문장인데 언어 규칙에만 일치하는 줄은, 같은 언어의 줄이 블록에
+# min_language_lines개 이상 있거나 일반 규칙의 코드 줄과 이어질 때만 코드로 봅니다. (예: "Note: 참고", "AND then ...")
+_LANGUAGE_RULES = {
+    # 다른 언어와 같이 쓰는 키워드(if, return, import 등)는 python 모양일 때만 셈
+    "python": [
+        r"(?:if|elif|else|for|while|def|class|try|except|finally|with|async\s+(?:def|for|with))\b[^#]*:\s*(?:#.*)?$",  # 콜론으로 끝나는 블록 문
+        r"(?:elif|except|def|lambda|nonlocal|global|assert|raise|pass)\b",
+        r"import\s+[\w.]+(?:\s+as\s+\w+)?(?:\s*,\s*[\w.]+(?:\s+as\s+\w+)?)*$",
+        r"from\s+[\w.]+\s+import\b",
+        r"@",  # 데코레이터
+    ],
+    "sql": [
+        r"(?:SELECT|INSERT\s+INTO|UPDATE|DELETE\s+FROM|CREATE\s+(?:TABLE|INDEX|VIEW|DATABASE|UNIQUE)|ALTER\s+TABLE|DROP\s+(?:TABLE|INDEX|VIEW)"
+        r"|FROM|WHERE|AND|OR|(?:LEFT|RIGHT|INNER|OUTER|FULL|CROSS)\s+JOIN|JOIN|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|OFFSET|VALUES|UNION|SET)\b",
+        # 소문자 SQL은 키워드 뒤가 SQL 모양일 때만 (열 목록, 테이블 이름, 비교식)
+        r"(?i:select\s+(?:distinct\s+)?[\w.*()]+(?:\s+as\s+\w+)?(?:\s*,\s*[\w.*()]+(?:\s+as\s+\w+)?)*(?:\s+from\s+[\w.]+.*)?\s*;?$)",
+        r"(?i:from\s+[\w.]+(?:\s+(?:as\s+)?\w+)?\s*;?$)",
+        r"(?i:(?:where|and|or|having)\s+[\w.()]+\s*(?:[=<>!]|like\b|in\s*\(|is\s+(?:not\s+)?null\b|between\b))",
+        r"(?i:(?:(?:left|right|inner|outer|full|cross)\s+)?join\s+[\w.]+(?:\s+(?:as\s+)?\w+)?\s+on\b)",
+        r"(?i:(?:group|order)\s+by\s+[\w.]+(?:\s*,\s*[\w.]+)*(?:\s+(?:asc|desc))?\s*;?$)",
+        r"(?i:insert\s+into\s+[\w.]+\s*(?:\(|values\b)|update\s+[\w.]+\s+set\b|delete\s+from\s+[\w.]+|create\s+table\b)",
+        r"--\s",  # 주석
+    ],
+    "javascript": [
+        r"(?:const|let|var)\s+(?:[\w$]+|\[[^\]]*\]|\{[^}]*\})\s*[=;,:]",
+        r"(?:async\s+)?function\s*\*?\s*[\w$]*\s*\(",
+        r"(?:export\s+(?:default|const|let|var|function|class|async|\{|\*)|module\.exports\b)",
+        r"(?:import|export)\b.*\bfrom\s+['\"]",
+        r"(?:console|document|window)\.\w",
+        r"\}?\s*(?:else|catch|finally)\b.*\{$",
+        r"(?:if|for|while|switch|catch)\s*\(.*\)\s*\{$",  # 중괄호로 여는 제어문
+        r"class\s+[\w$]+(?:\s+extends\s+[\w$.]+)?\s*\{$",
+        r"(?:return|throw|break|continue)\b[^#]*;$",
+        r"[\w$.]+\([^#]*\);$",  # 세미콜론으로 끝나는 호출문
+        r"(?:[\w$]+|\([^()]*\))\s*=>",  # 화살표 함수
+    ],
+    "bash": [
+        r"\$\s+\S",  # 프롬프트
+        # 명령 뒤에는 옵션/경로 같은 ASCII 인자나 따옴표 문자열만 (한국어 문장이 이어지면 명령이 아님)
+        r"(?:sudo|pip3?|npm|npx|yarn|git|cd|ls|echo|docker|kubectl|curl|wget|apt(?:-get)?|brew|chmod|chown|mkdir|rm|cp|mv|cat|grep|conda|streamlit)"
+        r"(?:\s+(?:\"[^\"]*\"|'[^']*'|[-A-Za-z0-9_./~$*=:@,%+&|<>]+))*\s*$",
+    ],
+    "yaml": [
+        r"---$",
+        r"[a-z_][a-z0-9_.-]*:\s+[^\s#]+$",   # key: value (값이 한 단어)
+        r"-\s+[A-Za-z_][\w.-]*:(?:\s|$)",     # 목록 안의 매핑
+    ],
+}
+min_language_lines = 2  # 일반 규칙의 코드 줄 없이 언어 규칙만으로 코드 블록이 되려면 필요한 같은 언어 줄 수
+
+_language_line = None  # 언어별 일치 여부를 한 번에 구하는 정규식 (register_language에서 다시 컴파일)
+_language_hint = None  # 아무 언어 규칙에나 일치하는지만 보는 정규식
+_FENCE_OPEN = re.compile(r"(`{3,}|~{3,})")  # 줄 맨 앞의 마크다운 코드 펜스
+_CALL_PREFIX = re.compile(r"[a-zA-Z_][a-zA-Z0-9_\.]*\s*\(")
+_BRACKET = re.compile(r"[\(\)\[\]\{\}]")
+
+LANGUAGE_ONLY = "language"  # detect_line: 언어 규칙에만 일치한 줄
+
+
+def _compile_language_rules():
+    # 언어마다 (?=(?P<언어>...))? 선행 탐색 그룹을 두면 match 한 번으로 일치한 모든 언어를 알 수 있음
+    global _language_line, _language_hint
+    _language_line = re.compile("".join(
+        f"(?=(?P<{name}>{'|'.join(f'(?:{pattern})' for pattern in patterns)}))?"
+        for name, patterns in _LANGUAGE_RULES.items()
+    ))
+    _language_hint = re.compile("|".join(
+        f"(?:{pattern})" for patterns in _LANGUAGE_RULES.values() for pattern in patterns
+    ))
+
+
+def register_language(name: str, patterns: list):
+    """
+    코드 감지에 언어 규칙을 추가합니다. (이미 있는 언어면 규칙을 덧붙임)
+    name은 코드 펜스 언어 이름으로 그대로 쓰입니다.
+    """
+    _LANGUAGE_RULES.setdefault(name, []).extend(patterns)
+    _compile_language_rules()
+    render_mixed_content.cache_clear()
+
+
+_compile_language_rules()
+
+def _escape_newlines(match):
+    return match.group(0).replace("\n", "\\n")
 
 
 def escape_literal_newlines_fixed(code: str) -> str:
     """
     문자열 리터럴 내의 실제 개행문자를 \\n으로 이스케이프합니다.
     """
-    def esc_string_literals(match):
-        literal = match.group(0)
-        # 실제 개행문자(아스키 10)를 문자열 \\n으로 변환
-        literal = literal.replace("\n", "\\n")
-        return literal
-    
-    # 따옴표로 둘러싸인 문자열 리터럴들을 찾아서 처리
-    # 삼중 따옴표, 단일/이중 따옴표 모두 처리
-    code = re.sub(r'""".*?"""', esc_string_literals, code, flags=re.DOTALL)
-    code = re.sub(r"'''.*?'''", esc_string_literals, code, flags=re.DOTALL)
-    code = re.sub(r'"(?:[^"\\]|\\.)*"', esc_string_literals, code)
-    code = re.sub(r"'(?:[^'\\]|\\.)*'", esc_string_literals, code)
-    
-    return code
+    # 개행이 없으면 바꿀 것이 없음
+    if "\n" not in code:
+        return code
+    # 삼중 따옴표, 단일/이중 따옴표 리터럴을 왼쪽부터 한 번에 처리
+    return _STRING_LITERAL.sub(_escape_newlines, code)
 
 def is_code_line(line: str) -> bool:
+    """
+    줄 하나만 보고 분류합니다. 빈 줄은 None, 코드는 True, 일반 문장은 False.
+    (언어 규칙에만 일치하는 줄은 앞뒤 문맥이 있어야 코드로 볼 수 있으므로 False)
+    """
     stripped = line.strip()
     
     # 빈 줄은 컨텍스트에 따라 판단하도록 별도 처리
     if not stripped:
         return None  # 빈 줄은 컨텍스트로 판단
 
-    #괄호로만 이루어진 줄은 코드의 일부일 가능성 높음
-    if re.match(r'^[\(\)\[\]\{\}\s,]*$', stripped) and any(c in stripped for c in "(){}[]"):
-        return True
-    
-    # 명확한 코드 패턴들
-    if (
-        bool(re.match(r"^(for|if|elif|else|while|def|class|try|except|finally|with|async\s+def|await|match|case|return|yield|raise|break|continue|pass|import|from|global|nonlocal|assert)\b", stripped))
-        or stripped.startswith("#")
-        or stripped.startswith("@")
-        or line.startswith(" ") or line.startswith("\t")  # 들여쓰기된 줄
-    ):
-        return True
-    
-    # 함수 호출 패턴 (더 엄격하게)
-    if bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_\.]*\s*\([^)]*\)\s*$", stripped)):
-        return True
-    
-    # 변수 할당 패턴 (더 엄격하게)
-    if bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_,\s]*\s*=\s*.+", stripped)):
+    # 들여쓰기된 줄, 괄호로만 이루어진 줄, 파이썬 키워드, 주석, 데코레이터, 함수 호출, 변수 할당
+    if line[0] in " \t" or _CODE_LINE.match(stripped):
         return True
     
     # 괄호가 있지만 일반 문장일 가능성이 높은 경우들을 제외
-    if any(c in stripped for c in "(){}[]"):
-        # 문장 중간에 괄호가 있는 경우 (예: "이것은 (예시) 문장입니다") 제외
-        if (stripped.count('(') == stripped.count(')') and 
-            not any(stripped.startswith(op) for op in ['if ', 'for ', 'while ', 'def ', 'class ']) and
-            not bool(re.match(r"^[a-zA-Z_][a-zA-Z0-9_\.]*\s*\(", stripped))):
-            return False
-        return True
+    # (예: "이것은 (예시) 문장입니다"처럼 괄호 짝이 맞고 함수 호출로 시작하지 않는 문장)
+    if _BRACKET.search(stripped):
+        return not (stripped.count('(') == stripped.count(')') and not _CALL_PREFIX.match(stripped))
     
     return False
 
+def detect_line(line: str):
+    """
+    분할기용 분류. is_code_line과 같고, 일반 문장으로 본 줄이 언어 규칙에 일치하면 LANGUAGE_ONLY를 반환합니다.
+    """
+    is_code = is_code_line(line)
+    if is_code is False and _language_hint.match(line.strip()):
+        return LANGUAGE_ONLY
+    return is_code
+
+def _line_languages(line: str):
+    match = _language_line.match(line.strip())
+    if match.lastindex is None:
+        return ()
+    return [name for name, matched in match.groupdict().items() if matched is not None]
+
+render_cache_size = 512  # 프로세스 전체(모든 세션)에서 공유하는 렌더링 캐시 크기
+
+
+def render_message(message: dict) -> str:
+    """
+    메시지에 렌더링 결과를 함께 보관해서 내용이 바뀌지 않은 메시지는 다시 변환하지 않습니다.
+    (_로 시작하는 키는 저장/내보내기에서 제외됩니다)
+    """
+    cached = message.get("_rendered")
+    if cached is None or cached[0] is not message["content"]:
+        with metrics.span('render_mixed_content'):
+            cached = (message["content"], render_mixed_content(message["content"]))
+        message["_rendered"] = cached
+    return cached[1]
+
+
+@lru_cache(maxsize=render_cache_size)
 def render_mixed_content(content: str) -> str:
-    lines = content.splitlines()
-    current_block = []
-    current_type = None  # "code" or "text"
-    result_parts = []
-    
-    def flush():
-        nonlocal current_block, current_type
-        if not current_block:
-            return
-        text = "\n".join(current_block)
-        if current_type == "code":
-            text = escape_literal_newlines_fixed(text)
-            result_parts.append(f"```python\n{text}\n```")
-        else:
-            result_parts.append(text)
-        current_block = []
-    
-    # 빈 줄 처리를 위한 컨텍스트 분석
-    processed_lines = []
-    for i, line in enumerate(lines):
-        line_type = is_code_line(line)
-        if line_type is None:  # 빈 줄인 경우
-            # 앞뒤 줄의 타입을 확인
-            prev_type = None
-            next_type = None
-            
-            # 이전 비어있지 않은 줄 찾기
-            for j in range(i-1, -1, -1):
-                prev_check = is_code_line(lines[j])
-                if prev_check is not None:
-                    prev_type = prev_check
-                    break
-            
-            # 다음 비어있지 않은 줄 찾기
-            for j in range(i+1, len(lines)):
-                next_check = is_code_line(lines[j])
-                if next_check is not None:
-                    next_type = next_check
-                    break
-            
-            # 앞뒤가 모두 코드이면 빈 줄도 코드로 처리
-            if prev_type is True and next_type is True:
-                line_type = True
-            else:
-                line_type = False
-        
-        processed_lines.append((line, line_type))
-    
-    # 블록 단위로 처리
-    for line, this_is_code in processed_lines:
-        new_type = "code" if this_is_code else "text"
-        
-        if current_type is None:
-            current_type = new_type
-        
-        if new_type != current_type:
-            flush()
-            current_type = new_type
-        
-        current_block.append(line)
-    
-    flush()
-    
+    # 스트리밍용 분할기와 같은 규칙을 사용 (전체 내용을 한 번에 넣고 닫음)
+    segmenter = IncrementalSegmenter()
+    for line in content.splitlines():
+        segmenter._add_line(line)
+    segmenter.close()
+
     # 결과를 하나의 문자열로 합치기
-    return "\n".join(result_parts)
+    return "\n".join(segmenter.blocks)
+
+
+class IncrementalSegmenter:
+    """
+    스트리밍 입력을 코드/텍스트 블록으로 나누는 증분 분할기.
+    델타가 들어오면 새로 완성된 줄만 분류하고, 확정된 블록은 blocks에 한 번만 추가합니다.
+    아직 끝나지 않은 마지막 블록(와 미완성 줄)은 render_tail()로 그때그때 계산합니다.
+
+    detect_code=True : render_mixed_content와 같은 규칙 (feed 후 close하면 결과가 완전히 같음)
+    detect_code=False: 이미 마크다운인 입력(assistant 응답)용. 코드 감지 없이
+                       ``` 펜스와 문단 경계에서만 블록을 나누고 내용은 그대로 둡니다.
+    """
+
+    def __init__(self, detect_code=True):
+        self.detect_code = detect_code
+        self.blocks = []       # 확정된 블록의 렌더링 결과 (추가만 됨)
+        self.block = []        # 진행 중인 블록의 줄
+        self.block_type = None # "code" or "text"
+        self.strong = 0        # 진행 중인 코드 블록에서 일반 규칙으로 코드인 줄 수
+        self.blanks = []       # 분류가 아직 정해지지 않은 빈 줄 (다음 줄을 봐야 결정됨)
+        self.prev_type = None  # 마지막 비어있지 않은 줄의 분류
+        self.fence = None      # 열려 있는 펜스 표시 (마크다운 모드)
+        self.tail = ""         # 아직 줄바꿈이 오지 않은 마지막 줄
+
+    def feed(self, delta: str):
+        pieces = (self.tail + delta).splitlines(keepends=True)
+        self.tail = ""
+        # 줄바꿈으로 끝나지 않은 조각, 또는 \r 뒤에 \n이 올 수 있는 조각은 다음 델타까지 보류
+        if pieces and (pieces[-1].endswith("\r") or len(pieces[-1].splitlines()[0]) == len(pieces[-1])):
+            self.tail = pieces.pop()
+        for piece in pieces:
+            self._add_line(piece.splitlines()[0])
+
+    def close(self):
+        """입력이 끝났을 때 남은 줄과 블록을 모두 확정합니다."""
+        for line in self.tail.splitlines():
+            self._add_line(line)
+        self.tail = ""
+        self._push_blanks(False)  # 뒤에 줄이 없으므로 남은 빈 줄은 텍스트
+        self._emit()
+
+    def pending_blocks(self) -> list:
+        """확정되지 않은 마지막 부분을 지금까지의 입력이 끝이라고 가정하고 블록으로 렌더링합니다."""
+        if not (self.block or self.blanks or self.tail):
+            return []
+        # 진행 중인 블록만 복사해서 끝까지 처리 (확정된 blocks는 건드리지 않음)
+        pending = IncrementalSegmenter(self.detect_code)
+        pending.block = list(self.block)
+        pending.block_type = self.block_type
+        pending.strong = self.strong
+        pending.blanks = list(self.blanks)
+        pending.prev_type = self.prev_type
+        pending.fence = self.fence
+        pending.tail = self.tail
+        pending.close()
+        return pending.blocks
+
+    def render_tail(self) -> str:
+        return "\n".join(self.pending_blocks())
+
+    def render(self) -> str:
+        """지금까지의 입력 전체를 렌더링합니다. (close 후에는 render_mixed_content 결과와 같음)"""
+        return "\n".join(self.blocks + self.pending_blocks())
+
+    def _add_line(self, line: str):
+        if not self.detect_code:
+            self._add_markdown_line(line)
+            return
+        kind = detect_line(line)
+        if kind is None:  # 빈 줄은 다음 비어있지 않은 줄이 올 때까지 보류
+            self.blanks.append(line)
+            return
+        line_type = kind is not False
+        # 앞뒤가 모두 코드이면 사이의 빈 줄도 코드
+        self._push_blanks(self.prev_type is True and line_type is True)
+        self._push(line, line_type)
+        if kind is True:
+            self.strong += 1
+        self.prev_type = line_type
+
+    def _push_blanks(self, is_code):
+        for blank in self.blanks:
+            self._push(blank, is_code)
+        self.blanks = []
+
+    def _push(self, line, is_code):
+        new_type = "code" if is_code else "text"
+        if self.block_type is None:
+            self.block_type = new_type
+        if new_type != self.block_type:
+            self._emit()
+            self.block_type = new_type
+        self.block.append(line)
+
+    def _emit(self):
+        if not self.block:
+            return
+        text = "\n".join(self.block)
+        language = self._language() if self.block_type == "code" else None
+        if language is not None:
+            if language == "python":  # 파이썬 문자열 규칙이므로 다른 언어에는 적용하지 않음
+                text = escape_literal_newlines_fixed(text)
+            text = f"```{language}\n{text}\n```"
+        self.blocks.append(text)
+        self.block = []
+        self.strong = 0
+
+    def _language(self):
+        # 블록이 확정될 때 한 번만 언어별 일치 줄 수를 셈
+        scores = {}
+        for line in self.block:
+            if line.strip():
+                for name in _line_languages(line):
+                    scores[name] = scores.get(name, 0) + 1
+        # 일치한 줄이 가장 많은 언어 (동점이면 _LANGUAGE_RULES에 먼저 등록된 언어)
+        best = "python"
+        for name in _LANGUAGE_RULES:
+            if scores.get(name, 0) > scores.get(best, 0):
+                best = name
+        # 언어 규칙에만 일치한 줄로 된 블록은 같은 언어 줄이 충분하지 않으면 일반 문장 (None)
+        if self.strong == 0 and scores.get(best, 0) < min_language_lines:
+            return None
+        return best
+
+    def _add_markdown_line(self, line):
+        if self.fence is not None:  # 펜스 안: 닫는 펜스가 나올 때까지 그대로 모음
+            self.block.append(line)
+            if line.strip().startswith(self.fence) and not line.strip().strip(self.fence[0]):
+                self.fence = None
+                self._emit()
+            return
+        fence = _FENCE_OPEN.match(line)
+        if fence:  # 맨 앞에서 시작하는 펜스만 블록 경계로 사용 (목록 안의 들여쓴 펜스는 제외)
+            self.block.extend(self.blanks)
+            self.blanks = []
+            self._emit()
+            self.fence = fence.group(1)
+            self.block.append(line)
+            return
+        if not line.strip():
+            self.blanks.append(line)
+            return
+        # 빈 줄 뒤에 들여쓰지 않은 줄이 오면 새 문단 (들여쓴 줄은 목록 항목의 이어지는 내용일 수 있음)
+        if self.blanks and self.block and line[0] not in " \t":
+            self.block.extend(self.blanks)
+            self.blanks = []
+            self._emit()
+        self.block.extend(self.blanks)
+        self.blanks = []
+        self.block.append(line)
+